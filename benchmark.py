@@ -0,0 +1,216 @@
+# Offline benchmark of the image pipeline over recorded maze images.
+#
+# Every image, and perturbed copies of it (rotated, brighter, darker, scaled),
+# goes through each stage of generate_navigation_directions_from_image on its
+# own, and then through the full pipeline: generating the navigation fields from
+# scratch and finding the path for one frame. Latency percentiles and throughput
+# are printed per variant, and can be saved as a baseline that later runs are
+# compared against.
+#
+# python benchmark.py --save-baseline baseline.json
+# python benchmark.py --baseline baseline.json
+#
+# Comparing against a baseline fails when a stage got slower or more images failed.
+import argparse
+import contextlib
+import fnmatch
+import glob
+import io
+import json
+import os
+import sys
+
+import cv2
+import numpy as np
+
+import process_maze_image as pipeline
+from bitboard_utils import Bitboard
+from image_utils import detect_corners, gridify2, pad_walls, corner_lower_bgr, corner_upper_bgr
+from matcher_utils import create_pose_estimator, POSE_BACKENDS
+from maze_utils import breadth_first_search, compute_wall_distances, create_direction_matrix, find_path
+from projection import Projector
+from stream_utils import IMAGE_EXTENSIONS
+from timing_utils import Metrics
+
+DEFAULT_IMAGES = "maze_images/*.jpg"
+DEFAULT_ROBOT = "maze_images/magic_marker.jpg"
+
+STAGES = ["corners", "projection", "pad", "robot_localization", "gridify2", "wall_distances", "bfs", "direction_matrix", "find_path"]
+
+# A p50 this much slower than the baseline's counts as a regression
+DEFAULT_TOLERANCE = 0.2
+
+def rotate(image, degrees):
+	h, w = image.shape[:2]
+	M = cv2.getRotationMatrix2D((w / 2, h / 2), degrees, 1)
+	return cv2.warpAffine(image, M, (w, h), borderMode=cv2.BORDER_REPLICATE)
+
+def brighten(image, delta):
+	return cv2.convertScaleAbs(image, alpha=1, beta=delta)
+
+def scale(image, factor):
+	return cv2.resize(image, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+
+VARIANTS = {
+	"original": lambda image: image,
+	"rotated": lambda image: rotate(image, 5),
+	"brighter": lambda image: brighten(image, 30),
+	"darker": lambda image: brighten(image, -30),
+	"scaled": lambda image: scale(image, 0.75),
+}
+
+class StageFailed(Exception):
+	pass
+
+# Runs every stage once on image, recording each one's latency in metrics
+def run_stages(image, localizer, metrics):
+	f = pipeline.desired_downscale_factor
+	with metrics.timer("corners"):
+		corners = detect_corners(image, corner_lower_bgr, corner_upper_bgr)
+	with metrics.timer("projection"):
+		projected = Projector(pipeline.height, pipeline.width, corners).warp(image)
+	with metrics.timer("pad"):
+		padded = pad_walls(projected, f)
+	with metrics.timer("robot_localization"):
+		pose = localizer.locate(padded)
+	if pose is None:
+		raise StageFailed("robot not found")
+	top_left, bottom_right, angle = pose
+	with metrics.timer("gridify2"):
+		grid = gridify2(padded, f, pipeline.wall_threshold, top_left, bottom_right) > 0
+	wall_distances = np.empty(grid.shape, dtype="uint8")
+	with metrics.timer("wall_distances"):
+		compute_wall_distances(grid, wall_distances)
+
+	radius = int(np.ceil((bottom_right[0] - top_left[0]) / 2 / f))
+	buffered = Bitboard.from_grid(grid).inflate(3 * radius // 4).to_grid()
+	directions = np.zeros(grid.shape, dtype="uint8")
+	distances = np.full(grid.shape, np.inf)
+	with metrics.timer("bfs"):
+		breadth_first_search(buffered, pipeline.destination, directions, distances)
+	with metrics.timer("direction_matrix"):
+		directions = create_direction_matrix(buffered, distances, wall_distances)
+
+	robot_center = ((top_left[0] + bottom_right[0]) // 2, (top_left[1] + bottom_right[1]) // 2)
+	with metrics.timer("find_path"):
+		find_path((robot_center[1] // f, robot_center[0] // f), directions, angle)
+
+# Runs the whole pipeline from scratch on image, as if it was a new maze
+def run_pipeline(image, robot_image, metrics):
+	pipeline.reset_maze_state()
+	# The pipeline prints its progress, which isn't what is being measured
+	with contextlib.redirect_stdout(io.StringIO()):
+		with metrics.timer("pipeline"):
+			directions, wall_booleans = pipeline.generate_navigation_directions_from_image(image, robot_image)
+			pipeline.find_path_for_robot_from_image_and_directions(image, robot_image, directions, wall_booleans)
+
+# {variant: Metrics} over every image, with repeat timed runs after one warm-up run
+def benchmark(images, robot_image, variants, repeat):
+	localizer = create_pose_estimator(robot_image, pipeline.pose_backend, pipeline.marker_bounds)
+	results = {}
+	for variant in variants:
+		metrics = results[variant] = Metrics()
+		for path, image in images:
+			perturbed = VARIANTS[variant](image)
+			# Only kept if every run gets through, so failures don't skew the stages they did reach
+			runs = Metrics()
+			try:
+				for run in range(repeat + 1):
+					# The warm-up run isn't recorded
+					recorded = runs if run > 0 else Metrics()
+					run_stages(perturbed, localizer, recorded)
+					run_pipeline(perturbed, robot_image, recorded)
+			except Exception as e:
+				metrics.count("failed")
+				print("{} ({}): {}".format(path, variant, e), file=sys.stderr)
+			else:
+				metrics.merge(runs)
+	return results
+
+# {variant: {stage: {count, mean, max, p50, p95, p99}, "throughput": images per second,
+# "failed": images that didn't make it through}}
+def summarize(results):
+	summary = {}
+	for variant, metrics in results.items():
+		metrics_summary = metrics.summary()
+		stages = metrics_summary["stages"]
+		summary[variant] = dict(stages)
+		if "pipeline" in stages:
+			summary[variant]["throughput"] = 1 / stages["pipeline"]["mean"]
+		summary[variant]["failed"] = metrics_summary["counters"].get("failed", 0)
+	return summary
+
+def print_summary(summary):
+	for variant, stages in summary.items():
+		print("{}: {:.2f} images/s, {} failed".format(variant, stages.get("throughput", 0), stages["failed"]))
+		for stage in STAGES + ["pipeline"]:
+			if stage in stages:
+				print("  {:<20} p50 {p50:9.3f} ms  p95 {p95:9.3f} ms  p99 {p99:9.3f} ms".format(stage, **{k: v * 1000 for k, v in stages[stage].items() if k.startswith("p")}))
+
+# Stages whose p50 is more than tolerance slower than in baseline, as
+# (variant, stage, baseline p50, p50)
+def regressions(summary, baseline, tolerance=DEFAULT_TOLERANCE):
+	slower = []
+	for variant, stages in summary.items():
+		for stage, stats in stages.items():
+			if stage in ("throughput", "failed") or stage not in baseline.get(variant, {}):
+				continue
+			before = baseline[variant][stage]["p50"]
+			if stats["p50"] > before * (1 + tolerance):
+				slower.append((variant, stage, before, stats["p50"]))
+	return slower
+
+# Variants where more images failed than in baseline, as (variant, baseline failures, failures).
+# A change that breaks a stage for every image leaves no timings to compare, only this.
+def new_failures(summary, baseline):
+	return [(variant, baseline[variant].get("failed", 0), stages["failed"]) for variant, stages in summary.items()
+		if variant in baseline and stages["failed"] > baseline[variant].get("failed", 0)]
+
+# Images matching pattern, whose file name part is matched regardless of case
+# (so *.jpg finds .JPG too), with one of the IMAGE_EXTENSIONS
+def image_paths(pattern):
+	directory, name = os.path.split(pattern)
+	paths = glob.glob(os.path.join(glob.escape(directory), "*"))
+	return sorted(path for path in paths if fnmatch.fnmatchcase(os.path.basename(path).lower(), name.lower()) and path.lower().endswith(IMAGE_EXTENSIONS))
+
+def main():
+	ap = argparse.ArgumentParser(description="Benchmark the maze pipeline on recorded images")
+	ap.add_argument("--images", default=DEFAULT_IMAGES, help="glob of maze images")
+	ap.add_argument("-r", "--robot", default=DEFAULT_ROBOT, help="path to the robot template")
+	ap.add_argument("-n", "--repeat", type=int, default=5, help="timed runs per image and variant")
+	ap.add_argument("--variants", default=",".join(VARIANTS), help="comma separated subset of " + ", ".join(VARIANTS))
+	ap.add_argument("--baseline", help="JSON summary of an earlier run to compare against")
+	ap.add_argument("--save-baseline", help="where to save this run's JSON summary")
+	ap.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="allowed p50 slowdown against the baseline")
+	ap.add_argument("-p", "--pose-backend", default=pipeline.pose_backend, choices=POSE_BACKENDS, help="how to find the robot")
+	args = ap.parse_args()
+	pipeline.pose_backend = args.pose_backend
+
+	robot_image = cv2.imread(args.robot)
+	paths = [path for path in image_paths(args.images) if path != args.robot]
+	images = [(path, cv2.imread(path)) for path in paths]
+	images = [(path, image) for path, image in images if image is not None]
+	if not images:
+		ap.error("no images match " + args.images)
+
+	results = benchmark(images, robot_image, args.variants.split(","), args.repeat)
+	summary = summarize(results)
+	print_summary(summary)
+
+	if args.save_baseline:
+		with open(args.save_baseline, "w") as f:
+			json.dump(summary, f, indent=2)
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		slower = regressions(summary, baseline, args.tolerance)
+		for variant, stage, before, after in slower:
+			print("SLOWER {} {}: p50 {:.3f} ms -> {:.3f} ms".format(variant, stage, before * 1000, after * 1000))
+		failing = new_failures(summary, baseline)
+		for variant, before, after in failing:
+			print("FAILING {}: {} -> {} images failed".format(variant, before, after))
+		if slower or failing:
+			sys.exit(1)
+
+if __name__ == "__main__":
+	main()
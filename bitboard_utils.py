@@ -0,0 +1,87 @@
+import numpy as np
+
+WORD_BITS = 64
+ONE = np.uint64(1)
+TOP_BIT_SHIFT = np.uint64(WORD_BITS - 1)
+
+# Wall grid packed one bit per square. Every row is stored as little-endian
+# uint64 words, so bit k of words[y][j] is square (y, 64 * j + k).
+#
+# Dilation shifts whole rows of words and ORs them together, which makes
+# obstacle inflation and occupancy queries cheap and the grid 8x smaller than
+# a bool array.
+class Bitboard:
+	def __init__(self, words, width):
+		self.words = words
+		self.width = width
+		self.height = words.shape[0]
+		# Valid bits of the last word in every row
+		self.last_word_mask = np.uint64((1 << (width % WORD_BITS)) - 1) if width % WORD_BITS else ~np.uint64(0)
+
+	@classmethod
+	def from_grid(cls, grid):
+		grid = np.asarray(grid, dtype=bool)
+		height, width = grid.shape
+		words_per_row = max(1, -(-width // WORD_BITS))
+		packed = np.zeros((height, words_per_row * 8), dtype="uint8")
+		packed[:, :-(-width // 8)] = np.packbits(grid, axis=1, bitorder="little")
+		return cls(packed.view("<u8"), width)
+
+	def to_grid(self):
+		packed = np.ascontiguousarray(self.words, dtype="<u8").view("uint8")
+		return np.unpackbits(packed, axis=1, count=self.width, bitorder="little").astype(bool)
+
+	def copy(self):
+		return Bitboard(self.words.copy(), self.width)
+
+	def is_wall(self, y, x):
+		return bool((self.words[y, x // WORD_BITS] >> np.uint64(x % WORD_BITS)) & ONE)
+
+	# Number of wall squares
+	def count(self):
+		return int(np.unpackbits(np.ascontiguousarray(self.words, dtype="<u8").view("uint8")).sum())
+
+	# Every square takes the value of its left neighbor (x - 1)
+	def shift_right(self):
+		shifted = self.words << ONE
+		shifted[:, 1:] |= self.words[:, :-1] >> TOP_BIT_SHIFT
+		shifted[:, -1] &= self.last_word_mask
+		return Bitboard(shifted, self.width)
+
+	# Every square takes the value of its right neighbor (x + 1)
+	def shift_left(self):
+		shifted = self.words >> ONE
+		shifted[:, :-1] |= self.words[:, 1:] << TOP_BIT_SHIFT
+		return Bitboard(shifted, self.width)
+
+	# Every square takes the value of the square above it (y - 1)
+	def shift_down(self):
+		shifted = np.zeros_like(self.words)
+		shifted[1:] = self.words[:-1]
+		return Bitboard(shifted, self.width)
+
+	# Every square takes the value of the square below it (y + 1)
+	def shift_up(self):
+		shifted = np.zeros_like(self.words)
+		shifted[:-1] = self.words[1:]
+		return Bitboard(shifted, self.width)
+
+	# Grows the walls by steps squares. By default only through the four neighbors
+	# of neighbors(), which matches thresholding a manhattan wall distance field;
+	# with diagonal=True it matches a chessboard one instead.
+	def dilate(self, steps=1, diagonal=False):
+		result = self
+		for _ in range(steps):
+			words = result.words | result.shift_left().words | result.shift_right().words
+			if diagonal:
+				horizontal = Bitboard(words, self.width)
+				words = words | horizontal.shift_up().words | horizontal.shift_down().words
+			else:
+				words = words | result.shift_up().words | result.shift_down().words
+			result = Bitboard(words, self.width)
+		return result
+
+	# Squares within radius (manhattan) of a wall, i.e. the same squares as
+	# compute_wall_distances(grid, wall_distances) followed by wall_distances <= radius
+	def inflate(self, radius):
+		return self.dilate(radius)
@@ -2,11 +2,15 @@ import cv2
 import bluetooth
 from process_maze_image import generate_navigation_directions_from_image, send_path_on_bluetooth, find_path_for_robot_from_image_and_directions
 from time import sleep
+from maze_utils import compute_run_tables
+from stream_utils import StreamingPipeline, default_frame_source
+from timing_utils import metrics
 
 DONT_GO_LONGER_THAN = 10 # squares
 sleeping = 0;
 counter = 0;
 
+@metrics.timed("send")
 def send_path_on_bluetooth(sock, path):
 	for i, path_element in enumerate(path):		
 		if i % 2 == 1:
@@ -39,7 +43,8 @@ robot_image = cv2.imread("maze_images/magic_marker.jpg")
 first_pic = cv2.imread("maze_images/current_maze.jpg")
 # first_pic = cv2.imread("maze_images/current_maze.jpg")
 directions_matrix, wall_booleans = generate_navigation_directions_from_image(first_pic, robot_image) # Also detect the destination!!
-first_path = find_path_for_robot_from_image_and_directions(first_pic, robot_image, directions_matrix, wall_booleans)
+run_tables = compute_run_tables(directions_matrix)
+first_path = find_path_for_robot_from_image_and_directions(first_pic, robot_image, directions_matrix, wall_booleans, run_tables)
 
 # truncated_path = truncate_path(first_path)
 print(first_path)
@@ -52,22 +57,42 @@ sock = bluetooth.BluetoothSocket (bluetooth.RFCOMM)
 sock.connect((bd_addr,port))
 
 
-send_path_on_bluetooth(sock, first_path[:2])
+if first_path is None:
+	# Robot not found on the first frame; the loop below plans again on the next ones
+	commanded_distance = 0
+else:
+	send_path_on_bluetooth(sock, first_path[:2])
+	commanded_distance = first_path[1] if len(first_path) > 1 else 0
 
-count = 1
-done = False
-while not done:
-	current_maze_picture = take_picture()
-	current_path = find_path_for_robot_from_image_and_directions(current_maze_picture.copy(), robot_image.copy(), directions_matrix.copy(), wall_booleans)
+# Frames keep being captured and planned on while the robot carries out the last
+# command; every stage works on the newest frame it has
+commanded = {"distance": commanded_distance}
+
+def plan(current_maze_picture):
+	current_path = find_path_for_robot_from_image_and_directions(current_maze_picture, robot_image.copy(), directions_matrix.copy(), wall_booleans, run_tables, commanded["distance"])
+	if current_path is None:
+		# Robot not found in this frame; wait for the next one
+		return None
 	if len(current_path) == 0:
-		break
-	#if count > 4 or len(current_path) <= 2: # Only one degree-turn and forward-move
-	#	done = True
+		pipeline.stop()
+		return None
 	#current_path = truncate_path(current_path)
+	return current_path
+
+def send(current_path):
 	send_path_on_bluetooth(sock, current_path[:2])
-	count += 1
-	print(counter)
-	counter += 1
+	commanded["distance"] = current_path[1] if len(current_path) > 1 else 0
+
+# Set MAZE_FRAMES to a file or directory of images to run without the camera
+pipeline = StreamingPipeline(default_frame_source(), [("plan", plan), ("send", send)]).start()
+try:
+	pipeline.join()
+finally:
+	pipeline.stop()
+	pipeline.report()
+	metrics.count("frames_dropped", sum(stats["dropped"] for stats in pipeline.stats().values()))
+	# Also dumped to the file named by MAZE_METRICS at exit
+	metrics.report()
 sock.close()
 		
 
@@ -0,0 +1,113 @@
+import atexit
+import os
+import queue
+import threading
+from enum import IntEnum
+
+import cv2
+
+# Environment variable that sets the level of the default sink, e.g. MAZE_DEBUG=verbose
+DEBUG_LEVEL_ENV = "MAZE_DEBUG"
+
+# Images that can wait to be written before new ones get dropped
+DEFAULT_QUEUE_SIZE = 16
+
+# Seconds close() waits for queued images to be written at exit
+DEFAULT_CLOSE_TIMEOUT = 5
+
+class DebugLevel(IntEnum):
+	OFF = 0
+	# A few images per maze, e.g. the projected maze and the final wall grid
+	BASIC = 1
+	# Every intermediate image, including per-frame ones
+	VERBOSE = 2
+
+	@classmethod
+	def parse(cls, value):
+		if value is None or value == "":
+			return cls.OFF
+		if isinstance(value, str) and not value.isdigit():
+			return cls[value.upper()]
+		return cls(int(value))
+
+# Collects debug images off the control loop.
+#
+# emit() takes either an image or a function that builds one. Below the sink's
+# level the function is never called, so debug images cost nothing when they are
+# turned off. Otherwise the image goes on a bounded queue and a background thread
+# encodes and writes it; when the queue is full the image is dropped instead of
+# stalling the caller.
+class DebugSink:
+	def __init__(self, level=DebugLevel.OFF, output_dir=".", max_queue=DEFAULT_QUEUE_SIZE):
+		self.level = DebugLevel.parse(level)
+		self.output_dir = output_dir
+		self.queue = queue.Queue(max_queue)
+		self.dropped = 0
+		# Images that couldn't be written, and the last error doing so
+		self.failed = 0
+		self.last_error = None
+		self.thread = None
+		self.lock = threading.Lock()
+
+	def enabled(self, level=DebugLevel.BASIC):
+		return level != DebugLevel.OFF and self.level >= level
+
+	# Queues image (or build(), if it is callable) to be written as name.
+	# Returns whether it was queued.
+	def emit(self, name, image, level=DebugLevel.BASIC):
+		if not self.enabled(level):
+			return False
+		if callable(image):
+			image = image()
+		self.start()
+		try:
+			self.queue.put_nowait((name, image))
+		except queue.Full:
+			self.dropped += 1
+			return False
+		return True
+
+	def start(self):
+		with self.lock:
+			if self.thread is None:
+				if self.output_dir:
+					os.makedirs(self.output_dir, exist_ok=True)
+				self.thread = threading.Thread(target=self.write_forever, name="debug-sink", daemon=True)
+				self.thread.start()
+
+	def write_forever(self):
+		while True:
+			item = self.queue.get()
+			try:
+				if item is None:
+					return
+				name, image = item
+				if not cv2.imwrite(os.path.join(self.output_dir, name), image):
+					raise IOError("Couldn't write " + name)
+			except Exception as e:
+				# One bad image mustn't stop the writer, or flush() and close() would wait forever
+				self.failed += 1
+				self.last_error = e
+			finally:
+				self.queue.task_done()
+
+	# Blocks until every queued image has been written
+	def flush(self):
+		if self.thread is not None:
+			self.queue.join()
+
+	# Stops the writer after the images already queued, waiting at most timeout
+	# seconds for them so that a stuck write can't hold up exit
+	def close(self, timeout=DEFAULT_CLOSE_TIMEOUT):
+		with self.lock:
+			thread, self.thread = self.thread, None
+		if thread is not None:
+			try:
+				self.queue.put(None, timeout=timeout)
+			except queue.Full:
+				return
+			thread.join(timeout)
+
+# Sink used by the pipeline modules, configured from the environment
+debug_sink = DebugSink(os.environ.get(DEBUG_LEVEL_ENV, DebugLevel.OFF))
+atexit.register(debug_sink.close)
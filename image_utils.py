@@ -2,9 +2,9 @@
 import numpy as np
 import argparse
 import cv2
-from sklearn.cluster import KMeans
 from projection import projection
 from math import ceil
+from debug_utils import debug_sink, DebugLevel
 
 # MAGIC NUMBERS
 WALL_THRESHOLD_DOWNSIZING = 50 # When downsizing the maze image to generate maze grid
@@ -14,50 +14,116 @@ WALL_THRESHOLD_UPSIZING = 0 # When upsizing, maze walls should already be 255 or
 wall_lower_bgr = np.asarray([0, 0, 90])
 wall_upper_bgr = np.asarray([70, 65, 190])
 
+# Corner marker color thresholds (green)
+corner_lower_bgr = np.asarray([20, 110, 120], dtype="uint8")
+corner_upper_bgr = np.asarray([80, 220, 220], dtype="uint8")
+
 wall_color = [12, 12, 90]
 RED = [0, 0, 255]
 
+# Corner-colored specks this close (in pixels) to a corner marker count as part of it
+CORNER_MERGE_MARGIN = 3
+
 # Takes a raw image of the maze and outputs the pixel coordinates (row,col) of its four corners
 #
 # image: image of the maze
 # corner_lower_bgr: numpy array of lower bounds for corner color
 # corner_upper_bgr: numpy array of upper bounds for corner color
 def detect_corners(image, corner_lower_bgr, corner_upper_bgr):
-	green_mask = cv2.inRange(image, corner_lower_bgr, corner_upper_bgr)
-	cv2.imwrite("YellowMask.png", green_mask)
-	output = cv2.bitwise_and(image, image, mask = green_mask)
-	green_corners = np.asarray(np.where(np.any(output != [0, 0, 0], axis=-1))).T
+	return find_corner_blobs(cv2.inRange(image, corner_lower_bgr, corner_upper_bgr))[0]
+
+# Finds the four corner markers in a mask of corner-colored pixels.
+# Returns (corners, boxes): corners as detect_corners returns them, and the
+# (min_x, min_y, max_x, max_y) bounding box of every marker in the same order.
+#
+# The markers are the four blobs (outer contours) with the largest bounding boxes,
+# together with any specks within CORNER_MERGE_MARGIN pixels of them; stray
+# corner-colored pixels elsewhere are ignored. If the mask has fewer than four
+# blobs, falls back to K-Means clustering over every pixel.
+def find_corner_blobs(green_mask):
+	contours = cv2.findContours(green_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+	if len(contours) < 4:
+		return find_corner_blobs_kmeans(green_mask)
+
+	rects = np.asarray([cv2.boundingRect(contour) for contour in contours])
+	all_boxes = np.concatenate((rects[:, :2], rects[:, :2] + rects[:, 2:] - 1), axis=1)
+
+	largest = np.argsort(rects[:, 2] * rects[:, 3], kind="stable")[::-1][:4]
+	boxes = all_boxes[largest].copy()
+	for i, seed in enumerate(all_boxes[largest]):
+		near = (all_boxes[:, 0] <= seed[2] + CORNER_MERGE_MARGIN) & (all_boxes[:, 2] >= seed[0] - CORNER_MERGE_MARGIN) \
+			& (all_boxes[:, 1] <= seed[3] + CORNER_MERGE_MARGIN) & (all_boxes[:, 3] >= seed[1] - CORNER_MERGE_MARGIN)
+		boxes[i, :2] = all_boxes[near, :2].min(axis=0)
+		boxes[i, 2:] = all_boxes[near, 2:].max(axis=0)
+	# (row, col) centers, like the K-Means cluster centers
+	centers = np.stack(((boxes[:, 1] + boxes[:, 3]) / 2, (boxes[:, 0] + boxes[:, 2]) / 2), axis=1)
+	return order_corner_blobs(centers, boxes)
+
+# Previous corner detector, used when the mask doesn't split into four blobs
+def find_corner_blobs_kmeans(green_mask):
+	from sklearn.cluster import KMeans
+	green_corners = np.asarray(np.nonzero(green_mask)).T
 
 	# Use K-Means clustering to produce four coordinates for the corners
 	kmeans = KMeans(n_clusters=4, random_state=0).fit(green_corners)
+	boxes = np.zeros(shape=(4, 4), dtype=int)
+	for label in range(4):
+		group = green_corners[kmeans.labels_ == label].T
+		boxes[label] = [np.min(group[1]), np.min(group[0]), np.max(group[1]), np.max(group[0])]
+	return order_corner_blobs(kmeans.cluster_centers_, boxes)
 
-	# Sort in order upper_left, upper_right, lower_right, lower_left
-	sum_centers = np.sum(kmeans.cluster_centers_, axis=1)
-	sorted_indices = sum_centers.argsort()
-	sorted_centers = np.take(kmeans.cluster_centers_, sorted_indices, axis=0)
-	
-	if sorted_centers[1][0] < sorted_centers[2][0]:
-		sorted_centers[1], sorted_centers[2] = sorted_centers[2], sorted_centers[1]
+# Sort four blobs in order upper_left, lower_left, upper_right, lower_right
+# and pick the outermost pixel coordinates (x, y) of each
+#
+# centers: (row, col) center of every blob
+# boxes: (min_x, min_y, max_x, max_y) bounding box of every blob
+def order_corner_blobs(centers, boxes):
+	sorted_indices = np.sum(centers, axis=1).argsort()
+	if centers[sorted_indices[1]][0] < centers[sorted_indices[2]][0]:
 		sorted_indices[1], sorted_indices[2] = sorted_indices[2], sorted_indices[1]
+	boxes = boxes[sorted_indices]
 
-	for i in sorted_centers:
-		i[0], i[1] = i[1], i[0]
-
+	result = np.zeros(shape=(4, 2))
 	# Want min_x, min_y
-	group0 = green_corners[np.where(kmeans.labels_ == sorted_indices[0])].T
+	result[0] = [boxes[0][0], boxes[0][1]]
 	# Want min_x, max_y
-	group1 = green_corners[np.where(kmeans.labels_ == sorted_indices[1])].T
+	result[1] = [boxes[1][0], boxes[1][3]]
 	# Want max_x, min_y
-	group2 = green_corners[np.where(kmeans.labels_ == sorted_indices[2])].T
-	# Want max_x, max_y	
-	group3 = green_corners[np.where(kmeans.labels_ == sorted_indices[3])].T
+	result[2] = [boxes[2][2], boxes[2][1]]
+	# Want max_x, max_y
+	result[3] = [boxes[3][2], boxes[3][3]]
+	return result.astype(np.float32), boxes
 
-	result = np.zeros(shape=(4, 2))
-	result[0] = np.asarray([np.min(group0[1]), np.min(group0[0])])
-	result[1] = np.asarray([np.min(group1[1]), np.max(group1[0])])
-	result[2] = np.asarray([np.max(group2[1]), np.min(group2[0])])
-	result[3] = np.asarray([np.max(group3[1]), np.max(group3[0])])
-	return result.astype(np.float32)
+# Temporal version of detect_corners for a camera that doesn't move between frames.
+#
+# After a full detection, only a small window around every corner marker is
+# thresholded on later frames. As long as the corner-colored pixels in every
+# window have moved by at most max_drift pixels, the previous corners are
+# returned as is.
+class CornerTracker:
+	def __init__(self, corner_lower_bgr, corner_upper_bgr, margin=10, max_drift=2):
+		self.corner_lower_bgr = corner_lower_bgr
+		self.corner_upper_bgr = corner_upper_bgr
+		self.margin = margin
+		self.max_drift = max_drift
+		self.corners, self.windows, self.window_boxes = None, None, None
+
+	def detect(self, image):
+		if self.corners is None or not self.in_place(image):
+			green_mask = cv2.inRange(image, self.corner_lower_bgr, self.corner_upper_bgr)
+			self.corners, boxes = find_corner_blobs(green_mask)
+			height, width = green_mask.shape
+			self.windows = [(max(0, min_x - self.margin), max(0, min_y - self.margin), min(width, max_x + self.margin + 1), min(height, max_y + self.margin + 1)) for min_x, min_y, max_x, max_y in boxes]
+			self.window_boxes = [cv2.boundingRect(green_mask[y0:y1, x0:x1]) for x0, y0, x1, y1 in self.windows]
+		return self.corners
+
+	# Whether every marker is still where it was at the last full detection
+	def in_place(self, image):
+		for (x0, y0, x1, y1), previous_box in zip(self.windows, self.window_boxes):
+			window = cv2.inRange(image[y0:y1, x0:x1], self.corner_lower_bgr, self.corner_upper_bgr)
+			if np.abs(np.subtract(cv2.boundingRect(window), previous_box)).max() > self.max_drift:
+				return False
+		return True
 
 # Takes a projected image of the maze and outputs a downscaled image whose pixel values are 
 # either [255, 255, 255] (white=wall is present) or [0, 0 0] (black=wall not present).
@@ -72,6 +138,11 @@ def gridify(projected, grid_width, grid_height, wall_threshold):
 	projected = cv2.cvtColor(projected, cv2.COLOR_BGR2GRAY)
 	threshed = cv2.threshold(projected, wall_threshold, 255, cv2.THRESH_BINARY)[1]
 
+	height, width = threshed.shape
+	downscale_factor = width // grid_width
+	if (grid_height * downscale_factor, grid_width * downscale_factor) == (height, width):
+		return block_walls(threshed, downscale_factor).astype("uint8") * 255
+
 	downsized = cv2.resize(threshed, dsize = (grid_width, grid_height), interpolation=cv2.INTER_AREA)
 
 	threshed_downsized = cv2.threshold(downsized, WALL_THRESHOLD_DOWNSIZING, 255, cv2.THRESH_BINARY)[1]
@@ -86,12 +157,20 @@ def gridify(projected, grid_width, grid_height, wall_threshold):
 # downscale_factor: each square(this number) patch of the image becomes 1 grid square
 # wall_threshold: threshold for detecting walls in the projected image
 def gridify2(projected, downscale_factor, wall_threshold, robot_top_left=None, robot_bottom_right=None):
-	BLACK = 0
-	#projected = cv2.cvtColor(projected, cv2.COLOR_BGR2GRAY)
-	#threshed = cv2.threshold(projected, wall_threshold, 255, cv2.THRESH_BINARY)[1]
+	grid = gridify_blocks(projected, downscale_factor, robot_top_left, robot_bottom_right)
+	threshed_downsized = grid.astype("uint8") * 255
+	debug_sink.emit("temp_walls_2.png", threshed_downsized, DebugLevel.VERBOSE)
+	return threshed_downsized
 
+# Same grid as gridify2, as a bool array, computed straight from the wall mask:
+# every downscale_factor x downscale_factor block is reduced to its count of wall
+# pixels, with the robot's box cleared in the mask first. No intermediate resized
+# image is built unless the mask's size isn't a multiple of downscale_factor, where
+# it is resized with INTER_AREA as before.
+def gridify_blocks(projected, downscale_factor, robot_top_left=None, robot_bottom_right=None):
+	BLACK = 0
 	threshed = cv2.inRange(projected, wall_lower_bgr, wall_upper_bgr)
-	cv2.imwrite("temp_walls.png", threshed)
+	debug_sink.emit("temp_walls.png", lambda: threshed.copy(), DebugLevel.VERBOSE)
 	h, w = threshed.shape
 	if robot_top_left is not None:
 		robot_y_min = max(0, robot_top_left[1] - 10)
@@ -99,14 +178,22 @@ def gridify2(projected, downscale_factor, wall_threshold, robot_top_left=None, r
 		robot_x_min = max(0, robot_top_left[0] - 10)
 		robot_x_max = min(w , robot_bottom_right[0] + 10)
 		threshed[robot_y_min:robot_y_max, robot_x_min:robot_x_max] = BLACK
+	grid_height, grid_width = h // downscale_factor, w // downscale_factor
+	if (grid_height * downscale_factor, grid_width * downscale_factor) == (h, w):
+		return block_walls(threshed, downscale_factor)
 
-	grid_height, grid_width = projected.shape[:2]
-	downsized = cv2.resize(threshed, dsize = (grid_width//downscale_factor, grid_height//downscale_factor), interpolation=cv2.INTER_AREA)
-
-	threshed_downsized = cv2.threshold(downsized, WALL_THRESHOLD_DOWNSIZING, 255, cv2.THRESH_BINARY)[1]
-	cv2.imwrite("temp_walls_2.png", threshed_downsized)
+	downsized = cv2.resize(threshed, dsize = (grid_width, grid_height), interpolation=cv2.INTER_AREA)
+	return downsized > WALL_THRESHOLD_DOWNSIZING
 
-	return threshed_downsized
+# Reduces every downscale_factor x downscale_factor block of a 0/255 mask to one bool
+# grid square. A square is a wall when the block's average, rounded like an INTER_AREA
+# resize would, is above WALL_THRESHOLD_DOWNSIZING. Leftover rows and columns that
+# don't fill a whole block are dropped.
+def block_walls(mask, downscale_factor):
+	grid_height, grid_width = mask.shape[0] // downscale_factor, mask.shape[1] // downscale_factor
+	blocks = mask[:grid_height * downscale_factor, :grid_width * downscale_factor].reshape(grid_height, downscale_factor, grid_width, downscale_factor)
+	wall_pixels = np.count_nonzero(blocks, axis=(1, 3))
+	return np.rint(wall_pixels * (255 / downscale_factor ** 2)) > WALL_THRESHOLD_DOWNSIZING
 
 # Takes the projected image of the maze and outputs this image, padded
 # with a few white pixels so that both the height and width are divisible
@@ -128,19 +215,57 @@ def pad_walls(projected, desired_downscale_factor):
 # proj: projected image
 # grid: downscaled grid
 def overlay_visualize(proj, grid):
-	upsized_grid = cv2.resize(grid, dsize = (proj.shape[1], proj.shape[0]), interpolation=cv2.INTER_NEAREST)
-	upscale_factor = proj.shape[1] // grid.shape[1]
-	threshed_upsized_grid = cv2.threshold(upsized_grid, WALL_THRESHOLD_UPSIZING, 255, cv2.THRESH_BINARY)[1]
+	return OverlayRenderer(grid, proj.shape).render(proj).copy()
+
+# Draws the wall grid over projected frames of one maze, plus whatever moves on top.
+#
+# The red wall layer and the grid lines only depend on the grid, so they are built
+# once. render() blends a frame with the wall layer into a preallocated buffer, the
+# same way overlay_visualize always has, copies the grid lines in through their
+# precomputed mask, and then draws the robot's box, the path and any other boxes on
+# top of it.
+class OverlayRenderer:
+	PATH_COLOR = [255, 0, 0, 255]
+	BOX_COLOR = [0, 255, 0, 255]
+	GRID_COLOR = [0, 0, 0, 255]
 
-	threshed_upsized_grid = cv2.cvtColor(threshed_upsized_grid, cv2.COLOR_GRAY2BGR)
-	threshed_upsized_grid[np.where((threshed_upsized_grid == [255, 255, 255]).all(axis = 2))] = RED
+	def __init__(self, grid, shape):
+		self.height, self.width = shape[:2]
+		self.frame = np.empty((self.height, self.width, 4), dtype="uint8")
+		self.buffer = np.empty((self.height, self.width, 4), dtype="uint8")
+		self.set_grid(grid)
 
-	threshed_upsized_grid_png = eliminate_black_background(threshed_upsized_grid)
-	projected_maze_png = add_alpha_channel(proj)
+	# Rebuilds the wall layer, for when the walls do change
+	def set_grid(self, grid):
+		grid = np.asarray(grid, dtype="uint8")
+		self.upscale_factor = self.width // grid.shape[1]
+		upsized_grid = cv2.resize(grid, dsize = (self.width, self.height), interpolation=cv2.INTER_NEAREST)
+		walls = cv2.threshold(upsized_grid, WALL_THRESHOLD_UPSIZING, 255, cv2.THRESH_BINARY)[1] > 0
+		self.walls = np.zeros((self.height, self.width, 4), dtype="uint8")
+		self.walls[walls] = RED + [255]
+		# Same lines as overlay_grid_lines, as a mask over a layer of GRID_COLOR
+		self.grid_lines = np.zeros((self.height, self.width), dtype="uint8")
+		self.grid_lines[:, ::self.upscale_factor] = 255
+		self.grid_lines[::self.upscale_factor, :] = 255
+		self.grid_layer = np.empty((self.height, self.width, 4), dtype="uint8")
+		self.grid_layer[:] = self.GRID_COLOR
 
-	overlay = cv2.addWeighted(projected_maze_png, 0.8, threshed_upsized_grid_png, 0.2, 0)
-	overlay_grid_lines(overlay, upscale_factor)
-	return overlay
+	# Returns the overlay of proj, with robot_box ((top_left, bottom_right)), boxes
+	# and path (grid squares (row, col)) drawn on top.
+	# The result is the renderer's buffer, which the next call overwrites.
+	def render(self, proj, robot_box=None, path=None, boxes=()):
+		cv2.cvtColor(proj, cv2.COLOR_BGR2BGRA, dst=self.frame)
+		cv2.addWeighted(self.frame, 0.8, self.walls, 0.2, 0, dst=self.buffer)
+		cv2.copyTo(self.grid_layer, self.grid_lines, self.buffer)
+		for top_left, bottom_right in boxes:
+			cv2.rectangle(self.buffer, tuple(int(v) for v in top_left), tuple(int(v) for v in bottom_right), self.BOX_COLOR, 1)
+		if path is not None and len(path) > 1:
+			half = self.upscale_factor // 2
+			points = np.int32([[x * self.upscale_factor + half, y * self.upscale_factor + half] for y, x in path])
+			cv2.polylines(self.buffer, [points], False, self.PATH_COLOR, 2)
+		if robot_box is not None:
+			cv2.rectangle(self.buffer, tuple(int(v) for v in robot_box[0]), tuple(int(v) for v in robot_box[1]), RED + [255], 2)
+		return self.buffer
 
 # Takes in a 3-channel image and outputs a 4-channel image where the
 # opacity of all black pixels [0, 0, 0] is 0 (made complete transparent)
@@ -1,56 +1,306 @@
 import numpy as np
 import cv2
 import math
-from matplotlib import pyplot as plt
+from debug_utils import debug_sink
 
 MIN_MATCH_COUNT = 10
 
-# Return angle in degrees that the robot has rotated from facing LEFT in the maze
-# as well as the top left and bottom right of the bounding box containing it
-def find_robot_angle(robot_img=cv2.imread("maze_images/raw_robot2.png"), maze_img=cv2.imread("raw_projected.png")):
-	img1 = cv2.cvtColor(robot_img, cv2.COLOR_BGR2GRAY)	# queryImage
-	img2 = cv2.cvtColor(maze_img, cv2.COLOR_BGR2GRAY)		# trainImage
-	# Initiate SIFT detector
-	sift = cv2.xfeatures2d.SIFT_create()
+# RANSAC inliers a match inside the tracking window needs to be trusted
+MIN_INLIER_COUNT = 6
 
-	# find the keypoints and descriptors with SIFT
-	kp1, des1 = sift.detectAndCompute(img1,None)
-	kp2, des2 = sift.detectAndCompute(img2,None)
+# Pixels of slack around the last bounding box when tracking, on top of the commanded motion
+TRACKING_MARGIN = 20
 
-	FLANN_INDEX_KDTREE = 0
-	index_params = dict(algorithm = FLANN_INDEX_KDTREE, trees = 5)
-	search_params = dict(checks = 50)
+# Lowe's ratio test: keep a match only if it is this much closer than the runner-up
+RATIO_TEST = 0.7
+# Hamming distances are coarser, so binary descriptors need a looser ratio
+ORB_RATIO_TEST = 0.8
 
-	flann = cv2.FlannBasedMatcher(index_params, search_params)
+# Keypoints the ORB backend extracts per image
+ORB_FEATURES = 1000
+# The robot is only ~70 pixels across in the projected maze; the default 31 pixel
+# ORB patch leaves almost no keypoints on it
+ORB_PATCH_SIZE = 15
 
-	matches = flann.knnMatch(des1,des2,k=2)
+# Side of the robot's footprint in projected pixels (about 9 cm at 8 pixels per cm)
+MARKER_ROBOT_SIZE = 72
 
-	# store all the good matches as per Lowe's ratio test.
-	good = []
-	for m,n in matches:
-	    if m.distance < 0.7*n.distance:
-	        good.append(m)
-	
-	src_pts = np.float32([ kp1[m.queryIdx].pt for m in good ]).reshape(-1,1,2)
-	dst_pts = np.float32([ kp2[m.trainIdx].pt for m in good ]).reshape(-1,1,2)
+# Environment variable that picks how the pipeline finds the robot, e.g. MAZE_POSE_BACKEND=orb
+POSE_BACKEND_ENV = "MAZE_POSE_BACKEND"
+# "sift" and "orb" match the robot template with RobotLocalizer, "markers" finds two
+# colored dots with MarkerPoseEstimator
+POSE_BACKENDS = ("sift", "orb", "markers")
 
-	M, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC,5.0)
-	
-	matchesMask = mask.ravel().tolist()
+# Environment variable with the dot colors for the "markers" backend, as 12 comma
+# separated numbers: front lower BGR, front upper BGR, rear lower BGR, rear upper BGR
+MARKER_BOUNDS_ENV = "MAZE_MARKER_BOUNDS"
+
+ROBOT_IMAGE_FILEPATH = "maze_images/raw_robot2.png"
+MAZE_IMAGE_FILEPATH = "raw_projected.png"
+
+# SIFT moved out of xfeatures2d in OpenCV 4.4
+def create_sift():
+	if hasattr(cv2, "SIFT_create"):
+		return cv2.SIFT_create()
+	return cv2.xfeatures2d.SIFT_create()
+
+# Finds the robot template in images of the maze.
+#
+# The template's keypoints and descriptors are extracted once and the detector
+# and matcher are kept between calls, so every frame only pays for its own
+# features and the match itself.
+#
+# backend: "sift" for SIFT with a FLANN kd-tree matcher (what find_robot_angle
+# has always used), or "orb" for ORB binary descriptors with brute-force Hamming
+# matching, which is much cheaper per frame
+class RobotLocalizer:
+	def __init__(self, robot_img, backend="sift"):
+		if backend == "sift":
+			FLANN_INDEX_KDTREE = 0
+			index_params = dict(algorithm = FLANN_INDEX_KDTREE, trees = 5)
+			search_params = dict(checks = 50)
+			self.detector = create_sift()
+			self.matcher = cv2.FlannBasedMatcher(index_params, search_params)
+			self.ratio_test = RATIO_TEST
+		elif backend == "orb":
+			self.detector = cv2.ORB_create(nfeatures=ORB_FEATURES, edgeThreshold=ORB_PATCH_SIZE, patchSize=ORB_PATCH_SIZE)
+			self.matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+			self.ratio_test = ORB_RATIO_TEST
+		else:
+			raise ValueError("Unknown feature backend: " + str(backend))
+		self.backend = backend
+
+		self.robot_img = robot_img.copy()
+		self.robot_gray = cv2.cvtColor(robot_img, cv2.COLOR_BGR2GRAY)
+		self.keypoints, self.descriptors = self.detector.detectAndCompute(self.robot_gray, None)
+		h,w = self.robot_gray.shape
+		self.outline = np.float32([ [0,0],[0,h-1],[w-1,h-1],[w-1,0] ]).reshape(-1,1,2)
+
+		# (top_left, bottom_right) of the robot the last time it was found
+		self.last_box = None
+		# How many track() calls had to search the whole frame
+		self.full_searches = 0
+
+	# Return (top_left, bottom_right, angle) like find_robot_angle does,
+	# or None if the robot can't be found in maze_img
+	def locate(self, maze_img):
+		match = self.match(cv2.cvtColor(maze_img, cv2.COLOR_BGR2GRAY))
+		if match is None:
+			return None
+		return self.remember(pose_from_homography(match[0], self.outline))
+
+	# Tracking version of locate() for consecutive frames. Only searches a window
+	# around the last known bounding box, grown by motion: how far (in pixels of
+	# maze_img) the robot was commanded to move since. Falls back to searching the
+	# whole frame if there is no previous box, or if the window gives fewer than
+	# MIN_MATCH_COUNT matches or MIN_INLIER_COUNT inliers, or a box whose size is
+	# off from the last one by more than a factor of two.
+	def track(self, maze_img, motion=0):
+		if self.last_box is not None:
+			x0, y0, x1, y1 = tracking_window(self.last_box, maze_img.shape, motion)
+			pose = self.locate_in_window(maze_img[y0:y1, x0:x1], x0, y0)
+			if pose is not None:
+				return pose
+		self.full_searches += 1
+		return self.locate(maze_img)
+
+	# Pose of the robot in a window whose top left is (x0, y0) of the maze image,
+	# in maze image coordinates, or None if the window isn't enough to go on
+	def locate_in_window(self, window, x0, y0):
+		match = self.match(cv2.cvtColor(window, cv2.COLOR_BGR2GRAY))
+		if match is None or np.count_nonzero(match[1]) < MIN_INLIER_COUNT:
+			return None
+		# Shift the homography from window coordinates back to maze_img coordinates
+		window_to_image = np.asarray([[1, 0, x0], [0, 1, y0], [0, 0, 1]], dtype=np.float64)
+		pose = pose_from_homography(window_to_image @ match[0], self.outline)
+		if not self.similar_size(pose):
+			return None
+		return self.remember(pose)
+
+	def similar_size(self, pose):
+		(min_x, min_y), (max_x, max_y) = self.last_box
+		(new_min_x, new_min_y), (new_max_x, new_max_y) = pose[:2]
+		old_size = np.asarray([max_x - min_x + 1, max_y - min_y + 1], dtype=np.float64)
+		new_size = np.asarray([new_max_x - new_min_x + 1, new_max_y - new_min_y + 1], dtype=np.float64)
+		return bool(np.all(new_size >= old_size / 2) and np.all(new_size <= old_size * 2))
+
+	def remember(self, pose):
+		self.last_box = pose[:2]
+		return pose
+
+	# Whether this localizer was built for robot_img
+	def serves(self, robot_img):
+		return np.array_equal(self.robot_img, robot_img)
+
+	# Matches the template against a grayscale image.
+	# Returns (M, mask, keypoints, good): the template-to-image homography, its
+	# RANSAC inlier mask, the image keypoints and the matches that passed the ratio
+	# test. Returns None with fewer than MIN_MATCH_COUNT good matches.
+	def match(self, gray):
+		if self.descriptors is None or len(self.keypoints) < 2:
+			return None
+		keypoints, descriptors = self.detector.detectAndCompute(gray, None)
+		if descriptors is None or len(keypoints) < 2:
+			return None
+
+		matches = self.matcher.knnMatch(self.descriptors, descriptors, k=2)
+
+		# store all the good matches as per Lowe's ratio test.
+		good = [pair[0] for pair in matches if len(pair) == 2 and pair[0].distance < self.ratio_test*pair[1].distance]
+		if len(good) < MIN_MATCH_COUNT:
+			return None
+
+		src_pts = np.float32([ self.keypoints[m.queryIdx].pt for m in good ]).reshape(-1,1,2)
+		dst_pts = np.float32([ keypoints[m.trainIdx].pt for m in good ]).reshape(-1,1,2)
+
+		M, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC,5.0)
+		if M is None:
+			return None
+		return M, mask, keypoints, good
 
-	h,w = img1.shape
-	pts = np.float32([ [0,0],[0,h-1],[w-1,h-1],[w-1,0] ]).reshape(-1,1,2)
-	dst = cv2.perspectiveTransform(pts,M)
+# Pose backend for a robot carrying two colored dots instead of a feature-rich marker.
+#
+# Each dot is segmented by color, and its largest blob's centroid comes from image
+# moments. The robot's center is halfway between the dots and it faces from the rear
+# dot towards the front one. locate() and track() return the same
+# (top_left, bottom_right, angle) as RobotLocalizer, with the box being the robot's
+# robot_size x robot_size footprint rotated to its heading.
+#
+# front_bounds, rear_bounds: (lower_bgr, upper_bgr) of each dot, measured on the
+# actual markers under the maze's lighting
+class MarkerPoseEstimator:
+	backend = "markers"
 
-	img2 = cv2.polylines(img2,[np.int32(dst)],True,255,3, cv2.LINE_AA)
+	def __init__(self, front_bounds, rear_bounds, robot_size=MARKER_ROBOT_SIZE):
+		self.front_bounds = front_bounds
+		self.rear_bounds = rear_bounds
+		self.robot_size = robot_size
+		self.last_box = None
+		self.full_searches = 0
+
+	# The dots don't depend on the robot template, so any template will do
+	def serves(self, robot_img):
+		return True
+
+	def locate(self, maze_img):
+		front = blob_centroid(maze_img, *self.front_bounds)
+		rear = blob_centroid(maze_img, *self.rear_bounds)
+		if front is None or rear is None:
+			return None
+		return self.remember(self.pose(front, rear))
+
+	# Only looks at a window around the last box, grown by motion pixels,
+	# falling back to the whole frame if either dot isn't in it
+	def track(self, maze_img, motion=0):
+		if self.last_box is not None:
+			x0, y0, x1, y1 = tracking_window(self.last_box, maze_img.shape, motion)
+			pose = self.locate_in_window(maze_img[y0:y1, x0:x1], x0, y0)
+			if pose is not None:
+				return pose
+		self.full_searches += 1
+		return self.locate(maze_img)
+
+	def locate_in_window(self, window, x0, y0):
+		front = blob_centroid(window, *self.front_bounds)
+		rear = blob_centroid(window, *self.rear_bounds)
+		if front is None or rear is None:
+			return None
+		return self.remember(self.pose(front + [x0, y0], rear + [x0, y0]))
+
+	def pose(self, front, rear):
+		center = (front + rear) / 2
+		# The template faces LEFT, so its x axis points from the front dot to the rear one
+		u = rear - front
+		u = u / max(np.hypot(u[0], u[1]), 1e-9) * self.robot_size / 2
+		v = np.asarray([-u[1], u[0]])
+		outline = np.float32([center - u - v, center - u + v, center + u + v, center + u - v]).reshape(-1,1,2)
+		return pose_from_outline(outline)
+
+	def remember(self, pose):
+		self.last_box = pose[:2]
+		return pose
+
+# ((front_lower, front_upper), (rear_lower, rear_upper)) from the MARKER_BOUNDS_ENV
+# format, or None if value is empty
+def parse_marker_bounds(value):
+	if not value:
+		return None
+	numbers = [int(n) for n in value.split(",")]
+	if len(numbers) != 12:
+		raise ValueError("Marker bounds need 12 numbers, got {}".format(len(numbers)))
+	lower_front, upper_front, lower_rear, upper_rear = (np.asarray(numbers[i:i + 3], dtype="uint8") for i in range(0, 12, 3))
+	return (lower_front, upper_front), (lower_rear, upper_rear)
+
+# Pose estimator for backend, one of POSE_BACKENDS. Every one of them has locate(),
+# track(), locate_in_window(), last_box, full_searches, backend and serves(robot_img).
+# marker_bounds: what parse_marker_bounds returns, needed by "markers"
+def create_pose_estimator(robot_img, backend="sift", marker_bounds=None):
+	if backend == "markers":
+		if marker_bounds is None:
+			raise ValueError("The markers backend needs the dot colors in " + MARKER_BOUNDS_ENV)
+		return MarkerPoseEstimator(*marker_bounds)
+	return RobotLocalizer(robot_img, backend)
+
+# (x0, y0, x1, y1) of the area a tracker searches first in an image of the given
+# shape: last_box grown by TRACKING_MARGIN plus motion pixels, clipped to the image
+def tracking_window(last_box, shape, motion=0):
+	(min_x, min_y), (max_x, max_y) = last_box
+	slack = TRACKING_MARGIN + int(math.ceil(motion))
+	h, w = shape[:2]
+	return max(0, min_x - slack), max(0, min_y - slack), min(w, max_x + slack + 1), min(h, max_y + slack + 1)
+
+# (x, y) centroid of the largest blob of img within [lower_bgr, upper_bgr], or None
+def blob_centroid(img, lower_bgr, upper_bgr):
+	mask = cv2.inRange(img, lower_bgr, upper_bgr)
+	contours = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+	if len(contours) == 0:
+		return None
+	moments = cv2.moments(max(contours, key=cv2.contourArea))
+	if moments["m00"] == 0:
+		return None
+	return np.asarray([moments["m10"] / moments["m00"], moments["m01"] / moments["m00"]])
+
+# Return angle in degrees that the robot has rotated from facing LEFT in the maze
+# as well as the top left and bottom right of the bounding box containing it
+#
+# Builds a new RobotLocalizer every call; keep one around to match many frames.
+def find_robot_angle(robot_img=None, maze_img=None):
+	if robot_img is None:
+		robot_img = cv2.imread(ROBOT_IMAGE_FILEPATH)
+	if maze_img is None:
+		maze_img = cv2.imread(MAZE_IMAGE_FILEPATH)
+	localizer = RobotLocalizer(robot_img)
+	img2 = cv2.cvtColor(maze_img, cv2.COLOR_BGR2GRAY)		# trainImage
+	match = localizer.match(img2)
+	if match is None:
+		return None
+	M, mask, kp2, good = match
+
+	debug_sink.emit("lol.png", lambda: draw_matches(localizer, img2, M, mask, kp2, good))
+
+	return pose_from_homography(M, localizer.outline)
+
+# Side-by-side image of the template, the maze with the robot outlined,
+# and the inlier matches between them
+def draw_matches(localizer, img2, M, mask, kp2, good):
+	matchesMask = mask.ravel().tolist()
+	dst = cv2.perspectiveTransform(localizer.outline,M)
+
+	img2 = cv2.polylines(img2.copy(),[np.int32(dst)],True,255,3, cv2.LINE_AA)
 	draw_params = dict(matchColor = (0,255,0), # draw matches in green color
 					   singlePointColor = None,
 					   matchesMask = matchesMask, # draw only inliers
 					   flags = 2)
-	img3 = cv2.drawMatches(img1,kp1,img2,kp2,good,None,**draw_params)
-	cv2.imwrite("lol.png", img3)
-	plt.imshow(img3, 'gray'),plt.show()
+	return cv2.drawMatches(localizer.robot_gray,localizer.keypoints,img2,kp2,good,None,**draw_params)
+
+# Return (top_left, bottom_right, angle) of the robot given the homography M
+# that maps the robot template's outline into the maze image
+def pose_from_homography(M, outline):
+	return pose_from_outline(cv2.perspectiveTransform(outline,M))
 
+# Return (top_left, bottom_right, angle) of the robot given where the template's
+# upper left, lower left, lower right and upper right corners ended up
+def pose_from_outline(dst):
 	# Transformed upper left, transformed upper right.
 	p2, q2 = dst[0][0], dst[3][0]
 	dy = q2[1] - p2[1]
@@ -59,6 +309,9 @@ def find_robot_angle(robot_img=cv2.imread("maze_images/raw_robot2.png"), maze_im
 	dst = dst.reshape(4,2).T
 	if dx > 0:
 		angle = -1 * 180 / math.pi * math.atan(dy/dx)
+	elif dx == 0:
+		# Straight up or down, which atan(dy/dx) can't tell apart
+		angle = -90 if dy > 0 else 90
 	else:
 		angle = 180 - 180 / math.pi * math.atan(dy/dx)
 
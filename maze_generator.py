@@ -0,0 +1,203 @@
+# Random mazes for testing the planner and the vision pipeline at any size.
+#
+# generate_walls() carves a perfect maze (exactly one route between any two cells)
+# and returns it as a wall_booleans grid like the pipeline builds from a photo.
+# render_maze() draws such a grid the way the camera sees the real maze: walls and
+# floor in the colors the thresholds expect, green corner markers, the robot's
+# marker, a perspective tilt, uneven lighting and sensor noise.
+#
+# Everything random comes from a numpy Generator, so the same seed always gives the
+# same maze and the same image.
+#
+# The defaults draw a 37 x 37 grid like the real maze's, with the middle of its middle
+# cell on the grid square process_maze_image navigates to.
+#
+# python maze_generator.py --rows 5 --cols 5 --seed 1 --output maze_images/synthetic
+import argparse
+
+import cv2
+import numpy as np
+
+from image_utils import corner_lower_bgr, corner_upper_bgr, wall_lower_bgr, wall_upper_bgr
+
+# Colors comfortably inside the thresholds the pipeline segments with
+WALL_BGR = (wall_lower_bgr + wall_upper_bgr) // 2
+CORNER_BGR = (corner_lower_bgr.astype(int) + corner_upper_bgr) // 2
+FLOOR_BGR = np.asarray([225, 225, 225])
+TABLE_BGR = np.asarray([70, 70, 70])
+
+DEFAULT_ROBOT_FILEPATH = "maze_images/magic_marker.jpg"
+
+# Passages of a rows x cols maze as (east, south) bool arrays:
+# east[r][c] when cell (r, c) opens onto (r, c + 1), south[r][c] onto (r + 1, c).
+#
+# "backtracker" is a depth-first search with long winding corridors, like a
+# hand-drawn maze. "binary_tree" opens every cell to the north or the east and is
+# computed for the whole grid at once, for mazes thousands of cells across.
+def generate_passages(rows, cols, rng, algorithm="backtracker"):
+	east = np.zeros((rows, cols), dtype=bool)
+	south = np.zeros((rows, cols), dtype=bool)
+	if algorithm == "binary_tree":
+		go_north = rng.random((rows, cols)) < 0.5
+		go_north[0, :] = False
+		go_north[:, -1] = True
+		go_north[0, -1] = False
+		east[:, :-1] = ~go_north[:, :-1]
+		east[0, :-1] = True
+		south[:-1, :] = go_north[1:, :]
+		return east, south
+	if algorithm != "backtracker":
+		raise ValueError("Unknown maze algorithm: " + str(algorithm))
+
+	visited = np.zeros((rows, cols), dtype=bool)
+	start = (int(rng.integers(rows)), int(rng.integers(cols)))
+	visited[start] = True
+	stack = [start]
+	while stack:
+		r, c = stack[-1]
+		options = [(dr, dc) for dr, dc in ((-1, 0), (1, 0), (0, -1), (0, 1))
+			if 0 <= r + dr < rows and 0 <= c + dc < cols and not visited[r + dr, c + dc]]
+		if not options:
+			stack.pop()
+			continue
+		dr, dc = options[rng.integers(len(options))]
+		if dr == 1:
+			south[r, c] = True
+		elif dr == -1:
+			south[r - 1, c] = True
+		elif dc == 1:
+			east[r, c] = True
+		else:
+			east[r, c - 1] = True
+		visited[r + dr, c + dc] = True
+		stack.append((r + dr, c + dc))
+	return east, south
+
+# Grid squares of a rows x cols maze whose corridors are cell_size squares wide and
+# whose walls are wall_thickness squares thick. True is a wall, like wall_booleans.
+# The grid is rows * (cell_size + wall_thickness) + wall_thickness squares tall.
+def generate_walls(rows, cols, cell_size=5, wall_thickness=2, seed=None, algorithm="backtracker"):
+	east, south = generate_passages(rows, cols, np.random.default_rng(seed), algorithm)
+	return passages_to_walls(east, south, cell_size, wall_thickness)
+
+def passages_to_walls(east, south, cell_size, wall_thickness):
+	rows, cols = east.shape
+	pitch = cell_size + wall_thickness
+	grid = np.ones((rows * pitch + wall_thickness, cols * pitch + wall_thickness), dtype=bool)
+	# (row, col, y, x) view of the square of every cell, plus the wall right and below it
+	cells = grid[wall_thickness:, wall_thickness:].reshape(rows, pitch, cols, pitch).transpose(0, 2, 1, 3)
+	cells[:, :, :cell_size, :cell_size] = False
+	cells[east, :cell_size, cell_size:] = False
+	cells[south, cell_size:, :cell_size] = False
+	return grid
+
+# Grid square (row, col) at the middle of maze cell (r, c)
+def cell_center(r, c, cell_size=5, wall_thickness=2):
+	pitch = cell_size + wall_thickness
+	return (wall_thickness + r * pitch + cell_size // 2, wall_thickness + c * pitch + cell_size // 2)
+
+# Draws wall_booleans as a photo of the maze. Returns (image, truth), where truth holds
+# "corners": the maze corners in the image, in the order detect_corners returns them,
+# "homography": the 3x3 map from top-down pixels to image pixels, and with a robot,
+# "robot_center" ((x, y) top-down pixels) and "robot_angle" (degrees from facing LEFT).
+#
+# square_pixels: top-down size of one grid square
+# robot_image: marker to draw (facing LEFT), robot_square: grid square to center it on,
+# robot_angle: heading in degrees, robot_pixels: its size in top-down pixels
+# frame_size: (height, width) of the image
+# tilt: how far each maze corner is moved at random, as a fraction of the maze's size
+# lighting: strength of the brightness gradient across the frame
+# noise: standard deviation of the per-pixel noise
+def render_maze(wall_booleans, seed=None, square_pixels=16, robot_image=None, robot_square=None, robot_angle=None, robot_pixels=None,
+		frame_size=(1080, 1920), tilt=0.05, lighting=0.15, noise=4):
+	rng = np.random.default_rng(seed)
+	rows, cols = wall_booleans.shape
+	height, width = rows * square_pixels, cols * square_pixels
+	truth = {}
+
+	top_down = np.empty((height, width, 3), dtype="uint8")
+	top_down[:] = FLOOR_BGR
+	top_down[cv2.resize(wall_booleans.astype("uint8"), (width, height), interpolation=cv2.INTER_NEAREST) > 0] = WALL_BGR
+
+	# The markers cover the corner squares, so their outermost pixels are the maze's corners
+	for x, y in ((0, 0), (0, height - square_pixels), (width - square_pixels, 0), (width - square_pixels, height - square_pixels)):
+		top_down[y:y + square_pixels, x:x + square_pixels] = CORNER_BGR
+
+	if robot_image is not None:
+		if robot_square is None:
+			open_squares = np.argwhere(~wall_booleans)
+			robot_square = tuple(open_squares[rng.integers(len(open_squares))])
+		if robot_angle is None:
+			robot_angle = float(rng.uniform(-180, 180))
+		if robot_pixels is None:
+			robot_pixels = 4 * square_pixels
+		center = ((robot_square[1] + 0.5) * square_pixels, (robot_square[0] + 0.5) * square_pixels)
+		draw_robot(top_down, robot_image, center, robot_angle, robot_pixels)
+		truth["robot_center"] = center
+		truth["robot_angle"] = robot_angle
+
+	# Where the maze's corners land in the frame: centered, filling most of its height,
+	# each moved at random by up to tilt of the maze's size
+	frame_height, frame_width = frame_size
+	fit = 0.8 * min(frame_height / height, frame_width / width)
+	half = np.asarray([width, height]) * fit / 2
+	middle = np.asarray([frame_width, frame_height]) / 2
+	source = np.float32([[0, 0], [0, height], [width, 0], [width, height]])
+	destination = middle + np.asarray([[-1, -1], [-1, 1], [1, -1], [1, 1]]) * half
+	destination += rng.uniform(-tilt, tilt, (4, 2)) * half * 2
+	destination = destination.astype(np.float32)
+	homography = cv2.getPerspectiveTransform(source, destination)
+	image = cv2.warpPerspective(top_down, homography, (frame_width, frame_height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=TABLE_BGR.tolist())
+	truth["corners"] = destination
+	truth["homography"] = homography
+
+	# A light source off to one side, then sensor noise and a slightly soft lens
+	direction = rng.uniform(-1, 1, 2)
+	ys, xs = np.mgrid[-1:1:frame_height * 1j, -1:1:frame_width * 1j]
+	gain = 1 + lighting * (direction[0] * xs + direction[1] * ys) / max(1e-9, np.abs(direction).sum())
+	noisy = image * gain[..., None] + rng.normal(0, noise, image.shape)
+	image = cv2.GaussianBlur(np.clip(noisy, 0, 255).astype("uint8"), (3, 3), 0)
+	return image, truth
+
+# Pastes robot_image onto image, robot_pixels wide, centered on center and turned to angle
+def draw_robot(image, robot_image, center, angle, robot_pixels):
+	size = int(round(robot_pixels))
+	marker = cv2.resize(robot_image, (size, size), interpolation=cv2.INTER_AREA)
+	# Big enough for the marker at any angle
+	side = int(np.ceil(size * np.sqrt(2))) + 2
+	M = cv2.getRotationMatrix2D((size / 2, size / 2), angle, 1)
+	M[:, 2] += (side - size) / 2
+	rotated = cv2.warpAffine(marker, M, (side, side), flags=cv2.INTER_LINEAR)
+	mask = cv2.warpAffine(np.full((size, size), 255, dtype="uint8"), M, (side, side), flags=cv2.INTER_NEAREST) > 0
+
+	x0, y0 = int(round(center[0] - side / 2)), int(round(center[1] - side / 2))
+	h, w = image.shape[:2]
+	cx0, cy0, cx1, cy1 = max(0, x0), max(0, y0), min(w, x0 + side), min(h, y0 + side)
+	window = image[cy0:cy1, cx0:cx1]
+	inside = mask[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0]
+	window[inside] = rotated[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0][inside]
+
+def main():
+	ap = argparse.ArgumentParser(description="Generate a random maze and a photo of it")
+	ap.add_argument("--rows", type=int, default=5, help="maze cells down")
+	ap.add_argument("--cols", type=int, default=5, help="maze cells across")
+	ap.add_argument("--cell", type=int, default=5, help="corridor width in grid squares")
+	ap.add_argument("--wall", type=int, default=2, help="wall thickness in grid squares")
+	ap.add_argument("--algorithm", default="backtracker", choices=["backtracker", "binary_tree"])
+	ap.add_argument("--seed", type=int, default=0)
+	ap.add_argument("--square-pixels", type=int, default=16, help="top-down pixels per grid square")
+	ap.add_argument("-r", "--robot", default=DEFAULT_ROBOT_FILEPATH, help="robot marker image, or '' for none")
+	ap.add_argument("-o", "--output", default="maze_images/synthetic", help="writes OUTPUT.png and OUTPUT_walls.npy")
+	args = ap.parse_args()
+
+	walls = generate_walls(args.rows, args.cols, args.cell, args.wall, args.seed, args.algorithm)
+	robot_image = cv2.imread(args.robot) if args.robot else None
+	# Starts in the top left cell, away from the destination in the middle one
+	robot_square = cell_center(0, 0, args.cell, args.wall) if robot_image is not None else None
+	image, truth = render_maze(walls, args.seed, args.square_pixels, robot_image, robot_square)
+	cv2.imwrite(args.output + ".png", image)
+	np.save(args.output + "_walls", walls)
+	print("{} x {} grid, middle cell at {}, corners {}".format(walls.shape[0], walls.shape[1], cell_center(args.rows // 2, args.cols // 2, args.cell, args.wall), truth["corners"].tolist()))
+
+if __name__ == "__main__":
+	main()
@@ -1,6 +1,10 @@
 # Search
 import collections
+import hashlib
+import heapq
+import os
 import numpy as np
+import cv2
 from enum import Enum
 from matcher_utils import clip_to_range
 import math
@@ -64,21 +68,143 @@ def neighbors(point, grid):
 		result.append(((y, x+1), Direction.LEFT))
 	return result
 
-def compute_wall_distances(grid, wall_distances):
-	visited, queue = set(), collections.deque([])
-	walls = grid.nonzero()
-	for i in range(len(walls[0])):
-		wall = (walls[0][i], walls[1][i])
-		visited.add(wall)
-		wall_distances[wall[0]][wall[1]] = 0
-		queue.append(wall)
+# Metrics supported by compute_wall_distances
+class DistanceMetric(Enum):
+	MANHATTAN = cv2.DIST_L1
+	CHESSBOARD = cv2.DIST_C
+	EUCLIDEAN = cv2.DIST_L2
+
+# Fills wall_distances with the distance from every square to the nearest wall
+# square of grid, measured with metric. Manhattan matches the original
+# multi-source BFS over neighbors() exactly.
+#
+# Pass a float wall_distances array to keep fractional euclidean distances;
+# an integer array truncates them. If grid has no walls, wall_distances is
+# left untouched.
+def compute_wall_distances(grid, wall_distances, metric=DistanceMetric.MANHATTAN):
+	if not grid.any():
+		return
+	# distanceTransform measures the distance to the nearest ZERO pixel
+	free = np.logical_not(grid).astype("uint8")
+	distances = cv2.distanceTransform(free, metric.value, cv2.DIST_MASK_PRECISE)
+	if np.issubdtype(wall_distances.dtype, np.integer):
+		# Cast through int64 so that uint8 outputs wrap the same way the BFS did
+		distances = distances.astype(np.int64)
+	wall_distances[...] = distances
+
+# Direction code that each neighbor of a square gets to RETURN to it,
+# in the same order that neighbors() lists them (up, down, left, right)
+NEIGHBOR_RETURN_CODES = np.asarray([Direction.DOWN.value, Direction.UP.value, Direction.RIGHT.value, Direction.LEFT.value], dtype="uint8")
+
+# Flat indices (y * width + x) of the four neighbors of every square in frontier,
+# in the same order as neighbors(), along with whether each one is inside the grid
+def flat_neighbors(frontier, height, width):
+	ys, xs = np.divmod(frontier, width)
+	candidates = np.stack((frontier - width, frontier + width, frontier - 1, frontier + 1), axis=1)
+	valid = np.stack((ys > 0, ys < height-1, xs > 0, xs < width-1), axis=1)
+	return candidates, valid
+
+# Smallest unsigned dtype that holds every BFS distance on a grid of this shape,
+# with its maximum value left free to mark unreachable squares
+def distance_dtype(shape):
+	if shape[0] * shape[1] < np.iinfo(np.uint16).max:
+		return np.dtype(np.uint16)
+	return np.dtype(np.uint32)
+
+# Value that marks an unreachable square in a distances array:
+# np.inf for float arrays, the largest representable value for integer arrays
+def unreachable_value(distances):
+	if np.issubdtype(distances.dtype, np.integer):
+		return np.iinfo(distances.dtype).max
+	return np.inf
+
+# Wavefront bfs on grid from dest.
+# Returns (directions, distances) where directions holds the same codes as
+# breadth_first_search and distances is a compact unsigned integer array in
+# which unreachable squares (and walls) hold unreachable_value(distances).
+#
+# The frontier is kept as an array of flat indices and a whole level is expanded
+# at once. Within a level, squares are discovered in the same order as the
+# queue in a one-square-at-a-time bfs, so the first square to reach a neighbor
+# wins exactly as it would there.
+def wavefront_search(grid, dest):
+	height, width = grid.shape
+	directions = np.zeros(grid.shape, dtype="uint8")
+	distances = np.empty(grid.shape, dtype=distance_dtype(grid.shape))
+	distances.fill(unreachable_value(distances))
+	flat_directions, flat_distances = directions.reshape(-1), distances.reshape(-1)
+
+	# Squares that are walls or have already been visited
+	closed = np.ascontiguousarray(grid, dtype=bool).reshape(-1).copy()
+	start = dest[0] * width + dest[1]
+	closed[start] = True
+	flat_distances[start] = 0
+
+	frontier = np.asarray([start], dtype=np.int64)
+	return_codes = np.broadcast_to(NEIGHBOR_RETURN_CODES, (1, 4))
+	level = 0
+	while frontier.size:
+		level += 1
+		candidates, valid = flat_neighbors(frontier, height, width)
+		# Boolean indexing walks the (square, neighbor) pairs in row-major order,
+		# which is the order a queue-based bfs would discover them in
+		codes = np.broadcast_to(return_codes, candidates.shape)[valid]
+		candidates = candidates[valid]
+		unvisited = ~closed[candidates]
+		candidates, codes = candidates[unvisited], codes[unvisited]
+
+		# Keep only the first discovery of every square, in discovery order
+		_, first = np.unique(candidates, return_index=True)
+		first.sort()
+		frontier = candidates[first]
+		closed[frontier] = True
+		flat_directions[frontier] = codes[first]
+		flat_distances[frontier] = level
+	return directions, distances
+
+# Same result as wavefront_search(grid | ~allowed, dest), but only the allowed
+# squares are ever looked at, so the cost follows the size of allowed instead of
+# the grid's size or the number of bfs levels.
+#
+# The allowed open squares get compact ids with a table of their neighbors' ids,
+# and a queue-based bfs runs over that table. It discovers squares in the same
+# order as wavefront_search, so ties are broken the same way.
+def corridor_search(grid, dest, allowed):
+	height, width = grid.shape
+	directions = np.zeros(grid.shape, dtype="uint8")
+	distances = np.empty(grid.shape, dtype=distance_dtype(grid.shape))
+	distances.fill(unreachable_value(distances))
+
+	open_mask = np.logical_and(allowed, np.logical_not(grid)).reshape(-1)
+	start = dest[0] * width + dest[1]
+	# wavefront_search expands from dest even if it is a wall
+	open_mask[start] = True
+	squares = np.flatnonzero(open_mask)
+	candidates, valid = flat_neighbors(squares, height, width)
+	ids = np.minimum(np.searchsorted(squares, candidates), len(squares) - 1)
+	valid &= squares[ids] == candidates
+	neighbor_ids = np.where(valid, ids, -1).tolist()
+	return_codes = NEIGHBOR_RETURN_CODES.tolist()
+
+	start_id = int(np.searchsorted(squares, start))
+	levels = [-1] * len(squares)
+	codes = [0] * len(squares)
+	levels[start_id] = 0
+	queue = collections.deque([start_id])
 	while queue:
-		vertex = queue.popleft()
-		for adjacent, _ in neighbors(vertex, grid):
-			if adjacent not in visited:
-				visited.add(adjacent)
-				queue.append(adjacent)
-				wall_distances[adjacent[0]][adjacent[1]] = wall_distances[vertex[0]][vertex[1]] + 1
+		current = queue.popleft()
+		level = levels[current] + 1
+		for neighbor, code in zip(neighbor_ids[current], return_codes):
+			if neighbor >= 0 and levels[neighbor] < 0:
+				levels[neighbor] = level
+				codes[neighbor] = code
+				queue.append(neighbor)
+
+	levels = np.asarray(levels)
+	reached = levels >= 0
+	distances.reshape(-1)[squares[reached]] = levels[reached]
+	directions.reshape(-1)[squares[reached]] = np.asarray(codes, dtype="uint8")[reached]
+	return directions, distances
 
 # Performs bfs on grid
 # At the end, directions will be populated with elements in [0, 4]
@@ -87,51 +213,455 @@ def compute_wall_distances(grid, wall_distances):
 # 2 = go up
 # 3 = go right
 # 4 = go down
-def breadth_first_search(grid, dest, directions, distances): 
-    visited, queue = set(), collections.deque([dest])
-    directions[dest[0]][dest[1]] = Direction.NOWHERE.value
-    distances[dest[0]][dest[1]] = 0
-    visited.add(dest)
-    while queue: 
-        vertex = queue.popleft()
-        for adjacent, direction_code in neighbors(vertex, grid):
-            if adjacent not in visited and not grid[adjacent[0]][adjacent[1]]:
-                visited.add(adjacent)
-                queue.append(adjacent)
-                directions[adjacent[0]][adjacent[1]] = direction_code.value
-                distances[adjacent[0]][adjacent[1]] = distances[vertex[0]][vertex[1]] + 1
+#
+# Only squares reachable from dest are written, so distances keeps whatever
+# the caller filled it with (e.g. np.inf) everywhere else.
+def breadth_first_search(grid, dest, directions, distances):
+	search_directions, search_distances = wavefront_search(grid, dest)
+	reached = search_distances != unreachable_value(search_distances)
+	directions[reached] = search_directions[reached]
+	distances[reached] = search_distances[reached]
 
+# Direction to MOVE in to reach each neighbor, in neighbors() order (up, down, left, right)
+NEIGHBOR_MOVE_CODES = np.asarray([Direction.UP.value, Direction.DOWN.value, Direction.LEFT.value, Direction.RIGHT.value], dtype="uint8")
+
+# Stacks the four neighbor planes of array in neighbors() order, so that
+# result[k][i][j] is the value of the k-th neighbor of (i, j).
+# Squares whose k-th neighbor is outside the grid get fill.
+def neighbor_planes(array, fill):
+	padded = np.pad(array, 1, mode="constant", constant_values=fill)
+	return np.stack((padded[:-2, 1:-1], padded[2:, 1:-1], padded[1:-1, :-2], padded[1:-1, 2:]))
+
+# For every open square that isn't the destination, point towards the neighbor with
+# the smallest distance, breaking ties by the largest distance from the walls and
+# then by neighbors() order. Computed for the whole grid at once.
+# Squares that can't reach the destination point NOWHERE, like walls.
 def create_direction_matrix(grid, distances, wall_distances):
-	# Initialize as Direction.NOWHERE.value
-	result = np.zeros(shape=grid.shape, dtype="uint8")
-	for i in range(len(result)):
-		for j in range(len(result[0])):
-			if not grid[i][j] and distances[i][j] >= 1:
-				candidates = neighbors((i, j), grid)
-				best_direction = min(candidates, key=lambda c: (distances[c[0][0]][c[0][1]], -wall_distances[c[0][0]][c[0][1]]))
-				result[i][j] = best_direction[1].opposite().value
-			else:
-				result[i][j] = Direction.NOWHERE.value
+	inside = neighbor_planes(np.ones(grid.shape, dtype=bool), False)
+	neighbor_distances = neighbor_planes(distances, 0)
+	neighbor_clearances = neighbor_planes(np.asarray(wall_distances, dtype=np.float64), 0)
+
+	# Primary key: neighbor distance
+	best_distances = np.where(inside, neighbor_distances, unreachable_value(distances)).min(axis=0)
+	candidates = inside & (neighbor_distances == best_distances)
+
+	# Secondary key: neighbor distance from walls, larger is better
+	clearances = np.where(candidates, neighbor_clearances, -np.inf)
+	candidates &= clearances == clearances.max(axis=0)
+
+	# argmax picks the first remaining candidate, like min() does
+	result = NEIGHBOR_MOVE_CODES[np.argmax(candidates, axis=0)]
+	result[grid | (distances < 1) | (distances == unreachable_value(distances))] = Direction.NOWHERE.value
 	return result
 
-def find_path(source, directions, initial_angle):
+# Computes every field needed to navigate grid towards dest:
+# (distances, bfs directions, directions from create_direction_matrix)
+def compute_navigation_fields(grid, dest, wall_distances):
+	directions_simple, distances = wavefront_search(grid, dest)
+	return distances, directions_simple, create_direction_matrix(grid, distances, wall_distances)
+
+# Bounded LRU cache of compute_navigation_fields results, keyed on a hash of the
+# buffered wall grid, the destination and the robot-radius inflation that produced
+# the buffered grid. With cache_dir set, entries are also saved there as .npz files
+# and survive restarts of the script on the same maze.
+#
+# Cached arrays are shared between lookups, so they are returned read-only.
+class FieldCache:
+	def __init__(self, max_entries=16, cache_dir=None):
+		self.max_entries = max_entries
+		self.cache_dir = cache_dir
+		self.entries = collections.OrderedDict()
+		self.hits, self.misses = 0, 0
+		if cache_dir is not None:
+			os.makedirs(cache_dir, exist_ok=True)
+
+	@staticmethod
+	def key(grid, dest, inflation):
+		grid = np.ascontiguousarray(grid, dtype=bool)
+		digest = hashlib.sha1(str((grid.shape, tuple(int(c) for c in dest), inflation)).encode())
+		digest.update(np.packbits(grid).tobytes())
+		return digest.hexdigest()
+
+	# Returns (distances, directions_simple, directions) for grid and dest,
+	# computing them only if they aren't in memory or on disk yet
+	def fields(self, grid, dest, inflation, wall_distances):
+		key = self.key(grid, dest, inflation)
+		if key in self.entries:
+			self.hits += 1
+			self.entries.move_to_end(key)
+			return self.entries[key]
+
+		entry = self._load(key)
+		if entry is None:
+			self.misses += 1
+			entry = compute_navigation_fields(grid, dest, wall_distances)
+			self._save(key, entry)
+		else:
+			self.hits += 1
+		for field in entry:
+			field.setflags(write=False)
+
+		self.entries[key] = entry
+		while len(self.entries) > self.max_entries:
+			self.entries.popitem(last=False)
+		return entry
+
+	# Fills the cache for every candidate destination up front, so that switching
+	# goals later is a lookup. Only the last max_entries stay in memory.
+	def precompute(self, grid, dests, inflation, wall_distances):
+		for dest in dests:
+			self.fields(grid, dest, inflation, wall_distances)
+
+	def _path(self, key):
+		return os.path.join(self.cache_dir, key + ".npz")
+
+	def _load(self, key):
+		if self.cache_dir is None or not os.path.exists(self._path(key)):
+			return None
+		with np.load(self._path(key)) as saved:
+			return saved["distances"], saved["directions_simple"], saved["directions"]
+
+	def _save(self, key, entry):
+		if self.cache_dir is None:
+			return
+		distances, directions_simple, directions = entry
+		np.savez_compressed(self._path(key), distances=distances, directions_simple=directions_simple, directions=directions)
+
+# Keeps a distance/direction field up to date as squares of the wall grid change.
+#
+# Seeded from a field that was already computed for grid and dest (distances from
+# wavefront_search or breadth_first_search, directions from create_direction_matrix),
+# update() repairs distances and directions in place. Only squares whose distance
+# changes, plus their neighbors, are visited, so a small change to a mostly static
+# maze costs time proportional to the change rather than the grid.
+class IncrementalPlanner:
+	def __init__(self, grid, dest, distances, directions, wall_distances):
+		self.grid = np.array(grid, dtype=bool)
+		self.dest = tuple(dest)
+		self.distances = distances.copy()
+		self.directions = directions.copy()
+		# Signed, so that negating it for the tie-breaker never wraps around
+		self.wall_distances = np.array(wall_distances, dtype=np.float64)
+		self.unreachable = unreachable_value(self.distances)
+
+	# grid: the new wall grid
+	# changed_cells: squares whose value differs between grid and the previous grid.
+	#	If None, they are found by comparing against the previous grid.
+	# wall_distances: new tie-breaker field, if the walls it was computed from changed too
+	#
+	# Returns the set of squares whose direction changed.
+	def update(self, grid, changed_cells=None, wall_distances=None):
+		if changed_cells is None:
+			changed_cells = np.argwhere(self.grid != grid)
+		changed_cells = [tuple(int(c) for c in cell) for cell in changed_cells]
+		for cell in changed_cells:
+			self.grid[cell] = grid[cell]
+
+		dirty = set(changed_cells)
+		invalidated = self._invalidate(changed_cells, dirty)
+		self._propagate(invalidated + changed_cells, dirty)
+
+		if wall_distances is not None:
+			wall_distances = np.asarray(wall_distances, dtype=np.float64)
+			for cell in np.argwhere(self.wall_distances != wall_distances):
+				dirty.add(tuple(int(c) for c in cell))
+			self.wall_distances = wall_distances.copy()
+
+		# A square's direction depends on its own distance and its neighbors' fields
+		region = set(dirty)
+		for cell in dirty:
+			region.update(adjacent for adjacent, _ in neighbors(cell, self.grid))
+
+		redirected = set()
+		for cell in region:
+			direction = self._direction_at(cell)
+			if direction != self.directions[cell]:
+				self.directions[cell] = direction
+				redirected.add(cell)
+		return redirected
+
+	# Clears the distance of every square whose shortest path ran through a new wall.
+	# Squares are checked in increasing order of their old distance, and one keeps its
+	# distance as long as some neighbor still sits exactly one step closer.
+	def _invalidate(self, changed_cells, dirty):
+		heap = []
+		for cell in changed_cells:
+			old_distance = self.distances.item(cell)
+			if self.grid[cell] and cell != self.dest and old_distance != self.unreachable:
+				self._clear(cell, old_distance, heap)
+				dirty.add(cell)
+
+		invalidated = []
+		while heap:
+			distance, cell = heapq.heappop(heap)
+			if self.distances.item(cell) != distance:
+				continue
+			if any(self.distances.item(adjacent) == distance - 1 for adjacent, _ in neighbors(cell, self.grid)):
+				continue
+			self._clear(cell, distance, heap)
+			invalidated.append(cell)
+			dirty.add(cell)
+		return invalidated
+
+	def _clear(self, cell, old_distance, heap):
+		self.distances[cell] = self.unreachable
+		for adjacent, _ in neighbors(cell, self.grid):
+			if self.distances.item(adjacent) == old_distance + 1:
+				heapq.heappush(heap, (old_distance + 1, adjacent))
+
+	# Re-seeds the given squares from their neighbors and lowers distances outwards
+	# from them, Dijkstra style, until the field is consistent again.
+	def _propagate(self, seeds, dirty):
+		heap = []
+		for cell in seeds:
+			if self.grid[cell] or cell == self.dest:
+				continue
+			best = min(self.distances.item(adjacent) for adjacent, _ in neighbors(cell, self.grid))
+			if best != self.unreachable and best + 1 < self.distances.item(cell):
+				self.distances[cell] = best + 1
+				heapq.heappush(heap, (best + 1, cell))
+				dirty.add(cell)
+
+		while heap:
+			distance, cell = heapq.heappop(heap)
+			if self.distances.item(cell) != distance:
+				continue
+			for adjacent, _ in neighbors(cell, self.grid):
+				if not self.grid[adjacent] and distance + 1 < self.distances.item(adjacent):
+					self.distances[adjacent] = distance + 1
+					heapq.heappush(heap, (distance + 1, adjacent))
+					dirty.add(adjacent)
+
+	# Same rule as create_direction_matrix, for a single square
+	def _direction_at(self, cell):
+		if self.grid[cell] or self.distances.item(cell) < 1:
+			return Direction.NOWHERE.value
+		best = min(neighbors(cell, self.grid), key=lambda c: (self.distances.item(c[0]), -self.wall_distances[c[0]]))
+		return best[1].opposite().value
+
+# Grid step (dy, dx) taken when moving in each direction, keyed by Direction value
+DIRECTION_STEPS = {
+	Direction.LEFT.value: (0, -1),
+	Direction.UP.value: (-1, 0),
+	Direction.RIGHT.value: (0, 1),
+	Direction.DOWN.value: (1, 0),
+}
+
+# Walks directions from source and returns the (direction, square) pairs along the way.
+# Returns None if the walk goes round in circles instead of ending on a square that
+# points NOWHERE, which a directions matrix only does around squares with no route.
+def trace_path(source, directions):
 	path = []
 	curr = source
 	# while we're not inside a wall or at the destination pointed to by directions
 	while directions[curr[0]][curr[1]] != Direction.NOWHERE.value:
+		if len(path) == directions.size:
+			return None
 		direction = directions[curr[0]][curr[1]]
 		path.append((direction, curr))
-		if direction == Direction.LEFT.value:
-			curr = (curr[0], curr[1]-1)
-		elif direction == Direction.UP.value:
-			curr = (curr[0]-1, curr[1])
-		elif direction == Direction.RIGHT.value:
-			curr = (curr[0], curr[1]+1)
-		elif direction == Direction.DOWN.value:
-			curr = (curr[0]+1, curr[1])
+		dy, dx = DIRECTION_STEPS[direction]
+		curr = (curr[0]+dy, curr[1]+dx)
+	return path
 
+# Turn/run-length list from source to the destination of directions, [] at the
+# destination or in a wall, and None if directions loops without reaching it
+def find_path(source, directions, initial_angle):
+	path = trace_path(source, directions)
+	if path is None:
+		return None
+	return process_path(path, initial_angle)
+
+# Precomputes, for every square, how many squares the robot travels in that square's
+# direction before the direction changes (run_lengths) and the flat index
+# (y * width + x) of the square where that run ends (run_ends).
+# Squares that point NOWHERE have a run length of 0 and end on themselves.
+#
+# Runs are resolved for the whole grid at once by pointer jumping, so this costs
+# O(log(longest run)) vectorized passes.
+def compute_run_tables(directions):
+	height, width = directions.shape
+	flat_directions = directions.reshape(-1)
+	offsets = np.zeros(256, dtype=np.int64)
+	offsets[Direction.LEFT.value], offsets[Direction.UP.value] = -1, -width
+	offsets[Direction.RIGHT.value], offsets[Direction.DOWN.value] = 1, width
+
+	squares = np.arange(flat_directions.size)
+	moving = flat_directions != Direction.NOWHERE.value
+	next_squares = np.clip(squares + offsets[flat_directions], 0, flat_directions.size - 1)
+	continues = moving & (flat_directions[next_squares] == flat_directions)
+
+	run_lengths = moving.astype(distance_dtype(directions.shape))
+	run_ends = next_squares.astype(np.int32)
+	pointers = np.where(continues, next_squares, -1)
+	active = np.flatnonzero(pointers >= 0)
+	while active.size:
+		jumps = pointers[active]
+		run_lengths[active] += run_lengths[jumps]
+		run_ends[active] = run_ends[jumps]
+		pointers[active] = pointers[jumps]
+		active = active[pointers[active] >= 0]
+	return run_lengths.reshape(directions.shape), run_ends.reshape(directions.shape)
+
+# Same as find_path, but uses the tables from compute_run_tables to jump from
+# turn to turn instead of walking the directions matrix one square at a time.
+# Returns None in the same cases.
+def find_path_from_runs(source, directions, run_lengths, run_ends, initial_angle):
+	flat_directions, flat_lengths, flat_ends = directions.reshape(-1), run_lengths.reshape(-1), run_ends.reshape(-1)
+	curr = source[0] * directions.shape[1] + source[1]
+	if flat_directions[curr] == Direction.NOWHERE.value:
+		return process_path([], initial_angle)
+
+	prev_dir = Direction(int(flat_directions[curr]))
+	result = [prev_dir.turn_calculation(initial_angle), int(flat_lengths[curr])]
+	curr = flat_ends[curr]
+	while flat_directions[curr] != Direction.NOWHERE.value:
+		# Every run takes at least one square, so more runs than squares is a loop
+		if len(result) > 2 * flat_directions.size:
+			return None
+		curr_dir = Direction(int(flat_directions[curr]))
+		result.append(curr_dir.turn_calculation(prev_dir.angle_from_LEFT()))
+		result.append(int(flat_lengths[curr]))
+		prev_dir = curr_dir
+		curr = flat_ends[curr]
+	return result
+
+# Single-query alternative to find_path that doesn't need a full directions matrix.
+# Returns the same turn/run-length list as find_path would for the directions
+# create_direction_matrix builds from grid, dest and wall_distances.
+#
+# A* runs from dest towards source with a manhattan heuristic, so the distance of
+# every closed square is its exact distance to dest. Expansion goes on until every
+# square that could lie on a shortest path is closed; the path is then walked from
+# source with the same (distance, wall clearance) tie-breaking as the full field.
+def find_path_astar(source, dest, grid, wall_distances, initial_angle):
+	source, dest = tuple(source), tuple(dest)
+
+	def heuristic(cell):
+		return abs(cell[0] - source[0]) + abs(cell[1] - source[1])
+
+	def clearance(cell):
+		return float(wall_distances[cell[0]][cell[1]])
+
+	distances, closed = {dest: 0}, set()
+	heap = [(heuristic(dest), 0, 0, dest)]
+	shortest = None
+	while heap:
+		f, _, g, vertex = heapq.heappop(heap)
+		if shortest is not None and f > shortest:
+			break
+		if vertex in closed or g != distances[vertex]:
+			continue
+		closed.add(vertex)
+		if vertex == source:
+			shortest = g
+		for adjacent, _ in neighbors(vertex, grid):
+			if not grid[adjacent[0]][adjacent[1]] and g + 1 < distances.get(adjacent, math.inf):
+				distances[adjacent] = g + 1
+				# Among equally promising squares, expand the ones farther from walls first
+				heapq.heappush(heap, (g + 1 + heuristic(adjacent), -clearance(adjacent), g + 1, adjacent))
+
+	path = []
+	if shortest is not None:
+		curr = source
+		while curr != dest:
+			best = min(neighbors(curr, grid), key=lambda c: (distances[c[0]] if c[0] in closed else math.inf, -clearance(c[0])))
+			direction = best[1].opposite()
+			path.append((direction.value, curr))
+			curr = best[0]
 	return process_path(path, initial_angle)
 
+# Conservative downsampling of a wall grid: a coarse square is a wall if any of
+# the factor x factor squares it covers is. Squares hanging past the edge of grid
+# count as walls.
+def reduce_walls(grid, factor=2):
+	height, width = grid.shape
+	coarse_height, coarse_width = -(-height // factor), -(-width // factor)
+	padded = np.ones((coarse_height * factor, coarse_width * factor), dtype=bool)
+	padded[:height, :width] = grid
+	return padded.reshape(coarse_height, factor, coarse_width, factor).any(axis=(1, 3))
+
+# [grid, grid reduced once, grid reduced twice, ...] with levels grids in total
+def build_wall_pyramid(grid, levels, factor=2):
+	pyramid = [np.asarray(grid, dtype=bool)]
+	for _ in range(levels - 1):
+		pyramid.append(reduce_walls(pyramid[-1], factor))
+	return pyramid
+
+# Square where mask is True closest to square and at most radius squares away
+# from it along each axis, or None
+def nearest_square(mask, square, radius):
+	y0, x0 = max(0, square[0] - radius), max(0, square[1] - radius)
+	ys, xs = np.nonzero(mask[y0:square[0] + radius + 1, x0:square[1] + radius + 1])
+	if len(ys) == 0:
+		return None
+	closest = np.argmin((ys + y0 - square[0]) ** 2 + (xs + x0 - square[1]) ** 2)
+	return (int(ys[closest] + y0), int(xs[closest] + x0))
+
+# Coarse-to-fine alternative to compute_navigation_fields for a single source.
+# Plans on the coarsest level of a wall pyramid, then at every finer level only
+# searches the squares within corridor coarse squares of the coarser path, with
+# corridor_search, so those levels cost as much as the corridor is big.
+# Returns (distances, directions) at full resolution; squares outside the final
+# corridor are unreachable and point NOWHERE, so find_path works as usual from source.
+#
+# The path can be slightly longer than the true shortest path. If the corridor
+# doesn't reach source at some level (e.g. a passage closed up when reducing),
+# the full-resolution grid is planned in full instead. That is the case for mazes
+# whose passages are only a square or two wide, where this is no faster than
+# compute_navigation_fields. On the maze grid scaled up 8 to 32 times it is about
+# 2.5 times faster.
+def coarse_to_fine_fields(grid, source, dest, wall_distances, levels=3, factor=2, corridor=1):
+	pyramid = build_wall_pyramid(grid, levels, factor)
+	kernel = np.ones((2 * corridor + 1, 2 * corridor + 1), dtype="uint8")
+	allowed = None
+	for level in reversed(range(1, levels)):
+		scale = factor ** level
+		level_grid = pyramid[level]
+		level_source = (source[0] // scale, source[1] // scale)
+		level_dest = (dest[0] // scale, dest[1] // scale)
+		# Coarse squares of source and dest are often walls only because a wall shares
+		# them, so the search starts and ends on the closest open squares instead
+		end = nearest_square(np.logical_not(level_grid), level_dest, corridor) or level_dest
+
+		if allowed is None:
+			directions, distances = wavefront_search(level_grid, end)
+		else:
+			directions, distances = corridor_search(level_grid, end, allowed)
+		start = nearest_square(distances != unreachable_value(distances), level_source, corridor)
+		if start is None:
+			# Planning the finer levels in full would cost more than the last one alone
+			allowed = None
+			break
+
+		on_path = np.zeros(level_grid.shape, dtype="uint8")
+		on_path[level_source] = 1
+		on_path[start] = 1
+		for _, square in trace_path(start, directions):
+			on_path[square] = 1
+		on_path[level_dest] = 1
+		on_path[end] = 1
+		on_corridor = cv2.dilate(on_path, kernel).astype(bool)
+		finer_shape = pyramid[level - 1].shape
+		allowed = on_corridor.repeat(factor, axis=0).repeat(factor, axis=1)[:finer_shape[0], :finer_shape[1]]
+
+	if allowed is not None:
+		directions, distances = corridor_search(grid, dest, allowed)
+		if distances[source] == unreachable_value(distances):
+			allowed = None
+	if allowed is None:
+		directions, distances = wavefront_search(grid, dest)
+	if allowed is None:
+		return distances, create_direction_matrix(grid, distances, wall_distances)
+
+	# Only the corridor's bounding box (and a square around it) can point anywhere
+	ys, xs = np.nonzero(allowed)
+	y0, x0 = max(0, ys.min() - 1), max(0, xs.min() - 1)
+	y1, x1 = min(grid.shape[0], ys.max() + 2), min(grid.shape[1], xs.max() + 2)
+	restricted = np.logical_or(grid[y0:y1, x0:x1], np.logical_not(allowed[y0:y1, x0:x1]))
+	directions = np.full(grid.shape, Direction.NOWHERE.value, dtype="uint8")
+	directions[y0:y1, x0:x1] = create_direction_matrix(restricted, distances[y0:y1, x0:x1], np.asarray(wall_distances)[y0:y1, x0:x1])
+	return distances, directions
+
 # Input: [255, 255, 191]
 # Output: [DONT_TURN, 2, TURN_LEFT, 1]
 def process_path(path, initial_angle):
@@ -162,6 +692,19 @@ def print_path(path):
 		print("Go forward " + str(path[index + 1]) + " squares.")
 		index += 2
 		
+# Angle from LEFT (in degrees) of the segment going diff_y squares down and diff_x squares right
+def segment_angle(diff_y, diff_x):
+	if diff_x == 0:
+		if diff_y > 0:
+			angle = 90
+		else:
+			angle = -90
+	elif diff_x > 0:
+		angle = 180 - 180 / math.pi * math.atan(diff_y/diff_x)
+	else:
+		angle = -1 * 180 / math.pi * math.atan(diff_y/diff_x)
+	return clip_to_range(angle)
+
 def condense_and_process_path(path, initial_angle):
 	result = []
 	current_angle = initial_angle
@@ -175,23 +718,55 @@ def condense_and_process_path(path, initial_angle):
 		diff_y = end_square[0] - start_square[0]
 		diff_x = end_square[1] - start_square[1]
 		
-		if diff_x == 0:
-			if diff_y > 0:
-				angle = 90
-			else:
-				angle = -90
-		elif diff_x > 0:
-			angle = 180 - 180 / math.pi * math.atan(diff_y/diff_x)
-		else:
-			angle = -1 * 180 / math.pi * math.atan(diff_y/diff_x)
-			
-		angle = clip_to_range(angle)
+		angle = segment_angle(diff_y, diff_x)
 		result.append(get_angle_diff(current_angle, angle))
 		result.append((diff_x * diff_x + diff_y * diff_y) ** 0.5)
 		current_angle = angle
 		index += CM_PER_MOVEMENT
 	return result
-		
+
+# Whether the straight segment between the centers of squares start and end stays
+# at least min_clearance squares away from the walls everywhere.
+# The segment is sampled every quarter of a square.
+def line_of_sight(start, end, wall_distances, min_clearance=1):
+	samples = 4 * max(abs(end[0] - start[0]), abs(end[1] - start[1])) + 1
+	ys = np.rint(np.linspace(start[0], end[0], samples)).astype(int)
+	xs = np.rint(np.linspace(start[1], end[1], samples)).astype(int)
+	return bool((wall_distances[ys, xs] >= min_clearance).all())
+
+# Any-angle alternative to condense_and_process_path. Takes the same (direction, square)
+# path, pulls it taut by skipping ahead to the farthest square still in line of sight
+# of the current corner, and returns the minimal [angle, distance, angle, distance...]
+# list that follows it. Distances are in squares.
+#
+# min_clearance: minimum distance from the walls every shortcut must keep. Use the
+# robot-radius inflation + 1 to never cut through the buffered walls.
+def smooth_and_process_path(path, initial_angle, wall_distances, min_clearance=1):
+	if len(path) == 0:
+		return []
+	last_direction, last_square = path[-1]
+	dy, dx = DIRECTION_STEPS[last_direction]
+	squares = [square for _, square in path] + [(last_square[0]+dy, last_square[1]+dx)]
+
+	corners, anchor = [squares[0]], 0
+	while anchor < len(squares) - 1:
+		reach = anchor + 1
+		while reach + 1 < len(squares) and line_of_sight(squares[anchor], squares[reach + 1], wall_distances, min_clearance):
+			reach += 1
+		corners.append(squares[reach])
+		anchor = reach
+
+	result = []
+	current_angle = initial_angle
+	for start_square, end_square in zip(corners, corners[1:]):
+		diff_y = end_square[0] - start_square[0]
+		diff_x = end_square[1] - start_square[1]
+		angle = segment_angle(diff_y, diff_x)
+		result.append(get_angle_diff(current_angle, angle))
+		result.append((diff_x * diff_x + diff_y * diff_y) ** 0.5)
+		current_angle = angle
+	return result
+
 def get_angle_diff(from_angle, to_angle):
 	diff = to_angle - from_angle
 	return clip_to_range(diff)
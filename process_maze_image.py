@@ -1,36 +1,38 @@
 # import the necessary packages
 from math import ceil
+import sys
+import os
+import glob
+import contextlib
+import io
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
-np.set_printoptions(threshold=np.nan)
+np.set_printoptions(threshold=sys.maxsize)
 import argparse
 import cv2
 # import bluetooth
-import time
-from projection import projection
-from image_utils import detect_corners, gridify, gridify2, overlay_visualize, pad_walls
-from maze_utils import breadth_first_search, find_path, compute_wall_distances, create_direction_matrix, Direction, print_path
-from matcher_utils import find_robot_angle, clip_to_range
+from projection import Projector
+from image_utils import CornerTracker, gridify_blocks, OverlayRenderer, pad_walls, corner_lower_bgr, corner_upper_bgr, wall_color
+from maze_utils import find_path, find_path_from_runs, compute_wall_distances, compute_run_tables, Direction, print_path, FieldCache, unreachable_value
+from matcher_utils import create_pose_estimator, parse_marker_bounds, clip_to_range, tracking_window, POSE_BACKENDS, POSE_BACKEND_ENV, MARKER_BOUNDS_ENV
+from bitboard_utils import Bitboard
+from debug_utils import debug_sink, DebugLevel
+from timing_utils import metrics
+from stream_utils import IMAGE_EXTENSIONS
 import math
-from motion_primitive_composition.motion_composition import execute_motion_composition
 
-start = time.clock()
 maze_image_filepath = "maze_images/current_maze.jpg"
 
 robot_coordinates_filepath = "maze_images/robot_coords.npy"
 wall_booleans_filepath = "maze_images/wall_booleans.npy"
 path_filepath = "maze_images/path_array.npy"
 
-# construct the argument parse and parse the arguments
-ap = argparse.ArgumentParser()
-ap.add_argument("-i", "--image", help = "path to the image")
-ap.add_argument("-r", "--robot", help = "path to the robot")
-args = vars(ap.parse_args())
-image = cv2.imread(args["image"])
-robot = cv2.imread(args["robot"]) # It's facing left
-
 # Threshold values for maze corner detection (green)
-lower =	np.array([20, 110, 120], dtype="uint8")
-upper = np.array([80, 220, 220], dtype = "uint8")
+lower, upper = corner_lower_bgr, corner_upper_bgr
+
+# The camera doesn't move, so corners found on one frame are reused while they stay put
+corner_tracker = CornerTracker(lower, upper)
 
 # Desired resolution of projected image
 # 91.3, 123.6 is REAL LIFE CM measurement
@@ -53,12 +55,143 @@ CM_PER_GRID_SQUARE = desired_downscale_factor / DESIRED_PIXELS_PER_CM
 # Threshold when processing grayscaled projected maze image
 wall_threshold = 210
 
-def find_path_for_robot_from_image_and_directions(maze_image, robot_image, directions, wall_booleans):
-	start_findpath_time = time.clock()
-	projected = projection(maze_image, height, width, detect_corners(maze_image, lower, upper))
-	padded = pad_walls(projected, desired_downscale_factor)
+# Grid square the robot is navigating to
+destination = (37//2, 37//2)
+
+# Projector for the corners the tracker last found
+projector = None
+
+# Projects maze_image onto a width x height top-down view of the maze, reusing the
+# warp maps from the previous frame as long as the maze corners haven't moved
+def project_maze(maze_image):
+	global projector
+	corners = corner_tracker.detect(maze_image)
+	if projector is None or not np.array_equal(projector.corners, corners):
+		projector = Projector(height, width, corners)
+	return projector.warp(maze_image)
+
+# How the robot is found, see matcher_utils.POSE_BACKENDS
+pose_backend = os.environ.get(POSE_BACKEND_ENV) or "sift"
+# Dot colors for the "markers" backend
+marker_bounds = parse_marker_bounds(os.environ.get(MARKER_BOUNDS_ENV))
+
+# Localizer for the robot template last passed in
+robot_localizer = None
+
+# Finds the robot in the padded projected maze, reusing the template features
+# from the previous call as long as the template and pose_backend are the same.
+# With tracking, only the area around where the robot was last seen is searched first,
+# grown by motion: how far in pixels the robot was told to move since.
+def locate_robot(robot_image, padded, tracking=False, motion=0):
+	global robot_localizer
+	if robot_localizer is None or robot_localizer.backend != pose_backend or not robot_localizer.serves(robot_image):
+		robot_localizer = create_pose_estimator(robot_image, pose_backend, marker_bounds)
+	if tracking:
+		return robot_localizer.track(padded, motion)
+	return robot_localizer.locate(padded)
+
+# Everything about the maze that stays put from frame to frame: the projection, the
+# padded image's geometry, the buffered wall grid, the navigation fields and the
+# robot localizer. generate_navigation_directions_from_image builds one, and from
+# then on a frame only goes through finding the robot and reading off its path.
+#
+# Finding the robot only projects the window around where it was last seen, and
+# projects and pads the whole frame only when that fails. The corners aren't looked
+# for again, so a new session is needed if the camera or maze moves.
+class MazeSession:
+	def __init__(self, projector, padded_shape, localizer, wall_booleans, distances, directions):
+		self.projector = projector
+		self.padded_shape = padded_shape[:2]
+		columns, rows = projector.size
+		# Rows and columns pad_walls added above and left of the projected image
+		self.top = (self.padded_shape[0] - rows) // 2
+		self.left = (self.padded_shape[1] - columns) // 2
+		self.localizer = localizer
+		self.wall_booleans = wall_booleans
+		self.distances = distances
+		self.directions = directions
+		self.run_tables = compute_run_tables(directions)
+		# Draws the walls under per-frame debug images
+		self.overlay_renderer = OverlayRenderer(wall_booleans, padded_shape)
+
+	# Whether this session was built for this robot template and direction field
+	def serves(self, robot_image, directions):
+		return self.localizer.serves(robot_image) and np.array_equal(self.directions, directions)
+
+	# The padded projected image of maze_image
+	def padded(self, maze_image):
+		return pad_walls(self.projector.warp(maze_image), desired_downscale_factor)
+
+	# padded(maze_image)[y0:y1, x0:x1], projecting only that region
+	def padded_region(self, maze_image, x0, y0, x1, y1):
+		region = np.empty((y1 - y0, x1 - x0, 3), dtype=maze_image.dtype)
+		region[:] = wall_color
+		columns, rows = self.projector.size
+		px0, py0 = max(0, x0 - self.left), max(0, y0 - self.top)
+		px1, py1 = min(columns, x1 - self.left), min(rows, y1 - self.top)
+		if px1 > px0 and py1 > py0:
+			projected = self.projector.warp_region(maze_image, (px0, py0), (px1, py1))
+			ox, oy = px0 + self.left - x0, py0 + self.top - y0
+			region[oy:oy + projected.shape[0], ox:ox + projected.shape[1]] = projected
+		return region
+
+	# (top_left, bottom_right, angle) of the robot in padded coordinates, looking around
+	# where it was last seen first, grown by motion pixels
+	def locate_robot(self, maze_image, motion=0):
+		if self.localizer.last_box is not None:
+			x0, y0, x1, y1 = tracking_window(self.localizer.last_box, self.padded_shape, motion)
+			pose = self.localizer.locate_in_window(self.padded_region(maze_image, x0, y0, x1, y1), x0, y0)
+			if pose is not None:
+				return pose
+		self.localizer.full_searches += 1
+		return self.localizer.locate(self.padded(maze_image))
+
+# Session of the last maze generate_navigation_directions_from_image was run on
+maze_session = None
+
+# Navigation fields already computed for a (buffered walls, destination, inflation)
+field_cache = FieldCache()
 
-	top_left, bottom_right, angle = find_robot_angle(robot_image, padded)
+# Forgets the corners, projection, navigation fields and session of the last maze,
+# so the next generate_navigation_directions_from_image starts from scratch.
+# The robot template's features are kept.
+def reset_maze_state():
+	global corner_tracker, projector, field_cache, maze_session
+	corner_tracker = CornerTracker(lower, upper)
+	projector = None
+	field_cache = FieldCache()
+	maze_session = None
+
+# run_tables: optional (run_lengths, run_ends) from compute_run_tables(directions),
+# used to extract the path one turn at a time instead of one square at a time
+# commanded_distance: how far (in cm) the robot was told to move since the last frame,
+# which sets how far from its last position to look for it
+# Returns None when the robot can't be found in maze_image or has no route to the
+# destination, and an empty path when it has arrived
+@metrics.timed("frame")
+def find_path_for_robot_from_image_and_directions(maze_image, robot_image, directions, wall_booleans, run_tables=None, commanded_distance=0):
+	motion = commanded_distance * DESIRED_PIXELS_PER_CM
+	session = maze_session if maze_session is not None and maze_session.serves(robot_image, directions) else None
+	if session is not None:
+		with metrics.timer("localization"):
+			pose = session.locate_robot(maze_image, motion)
+		if run_tables is None:
+			run_tables = session.run_tables
+	else:
+		with metrics.timer("projection"):
+			projected = project_maze(maze_image)
+			padded = pad_walls(projected, desired_downscale_factor)
+		with metrics.timer("localization"):
+			pose = locate_robot(robot_image, padded, tracking=True, motion=motion)
+	if pose is None:
+		# Lost the robot in this frame (blur, glare, a hand in the way): skip it rather
+		# than return an empty path, which means the robot has arrived
+		print("Robot not found, dropping the frame", flush=True)
+		metrics.count("robot_lost")
+		return None
+	top_left, bottom_right, angle = pose
+	if session is not None:
+		debug_sink.emit("robot_overlay.png", lambda: session.overlay_renderer.render(session.padded(maze_image), (top_left, bottom_right)).copy(), DebugLevel.VERBOSE)
 	robot_center = ((top_left[0] + bottom_right[0])//2, (top_left[1] + bottom_right[1])//2)
 	robot_center_gridsquare = (robot_center[1] // desired_downscale_factor, robot_center[0] // desired_downscale_factor)
 	
@@ -70,8 +203,18 @@ def find_path_for_robot_from_image_and_directions(maze_image, robot_image, direc
 	
 	#np.save("maze_images/robot_coords", robot_coords_npy)
 
-	path = find_path(robot_center_gridsquare, directions, angle)
+	with metrics.timer("path_extraction"):
+		if run_tables is None:
+			path = find_path(robot_center_gridsquare, directions, angle)
+		else:
+			path = find_path_from_runs(robot_center_gridsquare, directions, run_tables[0], run_tables[1], angle)
 	
+	if path is None or (len(path) == 0 and robot_center_gridsquare != destination):
+		# The robot's square has no route to the destination (or the robot is on a
+		# buffered wall). Returning [] would read as arrived, so drop the frame instead.
+		print("No route from " + str(robot_center_gridsquare) + ", dropping the frame", flush=True)
+		metrics.count("no_route")
+		return None
 	if len(path) == 0:
 		return path
 	
@@ -80,8 +223,6 @@ def find_path_for_robot_from_image_and_directions(maze_image, robot_image, direc
 			path[i] *= CM_PER_GRID_SQUARE
 			
 	print(path, flush=True)
-	end_findpath_time = time.clock()
-	print("Time to look at image and recompute path: " + str(end_findpath_time - start_findpath_time) + " seconds")
 	
 	numpy_path = np.zeros((len(path), 2))
 	for i, path_element in enumerate(path):
@@ -96,6 +237,8 @@ def find_path_for_robot_from_image_and_directions(maze_image, robot_image, direc
 	
 	# call error propagation function
 
+	# Pulls in PyQt5, so it is only imported once this is turned back on
+	#from motion_primitive_composition.motion_composition import execute_motion_composition
 	#after_error_prop = execute_motion_composition(robot_coords_npy, wall_booleans, numpy_path)
 	
 	after_error_prop_path = []
@@ -114,6 +257,10 @@ def find_path_for_robot_from_image_and_directions(maze_image, robot_image, direc
 def send_path_on_bluetooth(path):
 	return
 
+# Blows a grid up to the size of image, for debug images
+def upsize(grid, image):
+	return cv2.resize(grid, dsize=(image.shape[1], image.shape[0]), interpolation=cv2.INTER_NEAREST)
+
 # 109 x 74
 
 middle_second_column = (40,26)
@@ -123,63 +270,50 @@ top_third_column = (15, 46)
 enclosed_center = (40, 73)
 top_last_column = (15, 97)
 def generate_navigation_directions_from_image(maze_image, robot_image):
-	start_project_time = time.clock()
-	sorted_centers = detect_corners(maze_image, lower, upper)
-
-	projected = projection(maze_image, height, width, sorted_centers)
-	padded = pad_walls(projected, desired_downscale_factor)
-	end_project_time = time.clock()
-	cv2.imwrite("raw_projected.png", padded)
+	global maze_session
+	metrics.count("replans")
+	with metrics.timer("projection"):
+		projected = project_maze(maze_image)
+		padded = pad_walls(projected, desired_downscale_factor)
+	debug_sink.emit("raw_projected.png", padded)
 
 
 	# Find robot within padded
-	start_findrobot_time = time.clock()
-	top_left, bottom_right, angle = find_robot_angle(robot_image, padded)
+	with metrics.timer("localization"):
+		pose = locate_robot(robot_image, padded)
+	if pose is None:
+		raise ValueError("Robot not found in the maze image")
+	top_left, bottom_right, angle = pose
 	print(top_left, bottom_right, angle, flush=True)
 
-	end_findrobot_time = time.clock()
 	robot_center = ((top_left[0] + bottom_right[0])//2, (top_left[1] + bottom_right[1])//2)
 	robot_center_gridsquare = (robot_center[1] // desired_downscale_factor, robot_center[0] // desired_downscale_factor)
 	radius = ceil((bottom_right[0] - top_left[0]) / 2 / desired_downscale_factor)
 	print("Robot center gridsquare: " + str(robot_center_gridsquare), flush=True)
 
-	# start_gridify_time = time.clock()
-	maze_grid = gridify2(padded, desired_downscale_factor, wall_threshold, top_left, bottom_right)
-	# end_gridify_time = time.clock()
+	with metrics.timer("gridify"):
+		bools = gridify_blocks(padded, desired_downscale_factor, top_left, bottom_right)
 	# cv2.imwrite("temp.png", maze_grid)
 
-	bools = maze_grid.astype(bool)
-	distances_from_walls = np.empty(shape=maze_grid.shape, dtype="uint8")
-	directions_simple = np.zeros(shape=maze_grid.shape, dtype="uint8")
-	distances = np.full(maze_grid.shape, np.inf)
+	distances_from_walls = np.empty(shape=bools.shape, dtype="uint8")
 	
-	start_bfs_time = time.clock()
-	compute_wall_distances(bools, distances_from_walls)
+	with metrics.timer("wall_distances"):
+		compute_wall_distances(bools, distances_from_walls)
 
-	bools_buffered = distances_from_walls <= 3 * radius // 4
+		inflation = 3 * radius // 4
+		# Same squares as distances_from_walls <= inflation
+		bools_buffered = Bitboard.from_grid(bools).inflate(inflation).to_grid()
 	# np.save("maze_images/wall_booleans", bools_buffered)
 	
-	breadth_first_search(bools_buffered, (37//2,37//2), directions_simple, distances)
-	directions_smart = create_direction_matrix(bools_buffered, distances, distances_from_walls)
-	end_bfs_time = time.clock()
+	with metrics.timer("bfs"):
+		distances, directions_simple, directions_smart = field_cache.fields(bools_buffered, destination, inflation, distances_from_walls)
 
-	print("Projecion and corner detection: " + str(end_project_time - start_project_time))
-	print("Robot finding: " + str(end_findrobot_time - start_findrobot_time))
-	print("BFS to find distances from walls, distances from every square, directions from every square: " + str(end_bfs_time - start_bfs_time))
-	
-	visualized_maze_grid = overlay_visualize(padded, bools_buffered.astype("uint8"))
-	cv2.imwrite("projected_walls_grid_final.png", visualized_maze_grid)
-	
-	upsized_magic = cv2.resize(directions_smart, dsize=(padded.shape[1], padded.shape[0]), interpolation=cv2.INTER_NEAREST)
-	cv2.imwrite("magic2.png", upsized_magic)
-	
-	upsized_magic = cv2.resize(directions_simple, dsize=(padded.shape[1], padded.shape[0]), interpolation=cv2.INTER_NEAREST)
-	cv2.imwrite("magic1.png", upsized_magic)
-	
-	upsized_distances = cv2.resize(distances, dsize=(padded.shape[1], padded.shape[0]), interpolation=cv2.INTER_NEAREST)
-	cv2.imwrite("distances2.png", upsized_distances)
-	upsized_distances_from_walls = cv2.resize(distances_from_walls, dsize=(padded.shape[1], padded.shape[0]), interpolation=cv2.INTER_NEAREST)
-	cv2.imwrite("wall_distances_2.png", upsized_distances_from_walls * 28)
+	maze_session = MazeSession(projector, padded.shape, robot_localizer, bools_buffered, distances, directions_smart)
+	debug_sink.emit("projected_walls_grid_final.png", lambda: maze_session.overlay_renderer.render(padded).copy())
+	debug_sink.emit("magic2.png", lambda: upsize(directions_smart, padded), DebugLevel.VERBOSE)
+	debug_sink.emit("magic1.png", lambda: upsize(directions_simple, padded), DebugLevel.VERBOSE)
+	debug_sink.emit("distances2.png", lambda: upsize(distances, padded), DebugLevel.VERBOSE)
+	debug_sink.emit("wall_distances_2.png", lambda: upsize(distances_from_walls, padded) * 28, DebugLevel.VERBOSE)
 	return directions_smart, bools_buffered
 	
 
@@ -199,4 +333,93 @@ def generate_navigation_directions_from_image(maze_image, robot_image):
 
 	# sock.close()
 
-	
+# Robot template of a batch worker process, loaded once by init_batch_worker
+batch_robot_image = None
+
+def init_batch_worker(robot_filepath, backend):
+	global batch_robot_image, pose_backend
+	batch_robot_image = cv2.imread(robot_filepath)
+	pose_backend = backend
+	# One process per core already, so OpenCV's own threads would only compete
+	cv2.setNumThreads(1)
+
+# Raises ValueError if nothing can navigate session's fields: the destination is on a
+# (buffered) wall, or no other square can reach it
+def check_navigable(session):
+	if session.wall_booleans[destination]:
+		raise ValueError("destination {} is on a wall".format(destination))
+	reachable = np.count_nonzero(session.distances != unreachable_value(session.distances))
+	if reachable <= 1:
+		raise ValueError("no square can reach destination {}".format(destination))
+
+# Runs the whole pipeline on one maze image and saves its navigation artifact,
+# a compressed .npz of the buffered wall grid, the distances and directions to
+# destination, and the homography from the image to the projected maze.
+# Returns (maze_filepath, artifact path, seconds), or (maze_filepath, error, seconds),
+# without saving anything if the fields can't be navigated.
+def compile_maze(maze_filepath, output_dir):
+	start = time.perf_counter()
+	try:
+		maze_image = cv2.imread(maze_filepath)
+		if maze_image is None:
+			raise ValueError("can't read " + maze_filepath)
+		reset_maze_state()
+		# The pipeline prints its progress, which would interleave between workers
+		with contextlib.redirect_stdout(io.StringIO()):
+			generate_navigation_directions_from_image(maze_image, batch_robot_image)
+		check_navigable(maze_session)
+		name = os.path.splitext(os.path.basename(maze_filepath))[0]
+		artifact = os.path.join(output_dir, name + ".npz")
+		np.savez_compressed(artifact, wall_booleans=maze_session.wall_booleans, distances=maze_session.distances,
+			directions=maze_session.directions, homography=maze_session.projector.matrix,
+			corners=maze_session.projector.corners, destination=np.asarray(destination))
+		return maze_filepath, artifact, time.perf_counter() - start
+	except Exception as e:
+		return maze_filepath, e, time.perf_counter() - start
+
+# Maze images named by pattern: every image in it if it is a directory, otherwise a glob
+def batch_inputs(pattern):
+	if os.path.isdir(pattern):
+		pattern = os.path.join(pattern, "*")
+	return sorted(path for path in glob.glob(pattern) if path.lower().endswith(IMAGE_EXTENSIONS))
+
+# Compiles every maze image of pattern into output_dir on a pool of workers processes,
+# printing every image's time as it finishes. Returns the number of failures.
+def compile_mazes(pattern, robot_filepath, output_dir, workers=None, backend=None):
+	backend = backend or pose_backend
+	paths = batch_inputs(pattern)
+	os.makedirs(output_dir, exist_ok=True)
+	failures = 0
+	start = time.perf_counter()
+	with ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker, initargs=(robot_filepath, backend)) as pool:
+		futures = [pool.submit(compile_maze, path, output_dir) for path in paths]
+		for done, future in enumerate(as_completed(futures), 1):
+			maze_filepath, result, seconds = future.result()
+			if isinstance(result, Exception):
+				failures += 1
+				print("[{}/{}] {} failed after {:.3f} s: {}".format(done, len(paths), maze_filepath, seconds, result), flush=True)
+			else:
+				print("[{}/{}] {} -> {} in {:.3f} s".format(done, len(paths), maze_filepath, result, seconds), flush=True)
+	elapsed = time.perf_counter() - start
+	print("Compiled {} of {} mazes in {:.2f} s ({:.2f} mazes/s)".format(len(paths) - failures, len(paths), elapsed, len(paths) / elapsed if elapsed else 0), flush=True)
+	return failures
+
+if __name__ == "__main__":
+	# construct the argument parse and parse the arguments
+	ap = argparse.ArgumentParser()
+	ap.add_argument("-i", "--image", default=maze_image_filepath, help = "path to the image")
+	ap.add_argument("-r", "--robot", default="maze_images/magic_marker.jpg", help = "path to the robot")
+	ap.add_argument("-b", "--batch", help = "directory or glob of maze images to compile to navigation artifacts")
+	ap.add_argument("-o", "--output-dir", default="maze_images/compiled", help = "where --batch writes one .npz per maze")
+	ap.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help = "worker processes for --batch")
+	ap.add_argument("-p", "--pose-backend", default=pose_backend, choices=POSE_BACKENDS, help = "how to find the robot, overrides " + POSE_BACKEND_ENV)
+	args = vars(ap.parse_args())
+	pose_backend = args["pose_backend"]
+	if args["batch"]:
+		sys.exit(1 if compile_mazes(args["batch"], args["robot"], args["output_dir"], args["workers"]) else 0)
+	image = cv2.imread(args["image"])
+	robot = cv2.imread(args["robot"]) # It's facing left
+
+	directions, wall_booleans = generate_navigation_directions_from_image(image, robot)
+	find_path_for_robot_from_image_and_directions(image, robot, directions, wall_booleans)
+	metrics.report()
@@ -22,3 +22,42 @@ def projection(img, width, height, corners):
 
 	return final
 
+# Precomputed version of projection() for a camera and maze that don't move
+# between frames. The homography is computed once, along with remap lookup
+# tables giving the source pixel of every projected pixel, so projecting a
+# frame is a single cv2.remap.
+#
+# Takes the same width, height and corners as projection(), and warp(img)
+# returns the same image projection(img, width, height, corners) does, up to
+# rounding of the interpolation weights.
+class Projector:
+	def __init__(self, width, height, corners):
+		self.corners = np.array(corners, dtype="float32")
+		source = np.array([[0,0], [0,width], [height, 0], [height, width]], dtype = "float32")
+		self.matrix = cv2.getPerspectiveTransform(self.corners, source)
+		# Same (columns, rows) dsize that projection() hands to warpPerspective
+		self.size = (height, width)
+
+		columns, rows = self.size
+		xs, ys = np.meshgrid(np.arange(columns, dtype=np.float64), np.arange(rows, dtype=np.float64))
+		destination = np.stack((xs, ys, np.ones_like(xs)), axis=-1)
+		mapped = destination @ np.linalg.inv(self.matrix).T
+		map_x = (mapped[..., 0] / mapped[..., 2]).astype(np.float32)
+		map_y = (mapped[..., 1] / mapped[..., 2]).astype(np.float32)
+		self.map1, self.map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
+	def warp(self, img):
+		return cv2.remap(img, self.map1, self.map2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+
+	# Projects only the region [top_left, bottom_right) of the projected image,
+	# e.g. the area around the robot. Both corners are (x, y) projected pixel coordinates.
+	def warp_region(self, img, top_left, bottom_right):
+		columns, rows = self.size
+		x0, y0 = max(0, top_left[0]), max(0, top_left[1])
+		x1, y1 = min(columns, bottom_right[0]), min(rows, bottom_right[1])
+		return cv2.remap(img, self.map1[y0:y1, x0:x1], self.map2[y0:y1, x0:x1], cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+
+	# Maps (x, y) points of the raw image to projected coordinates
+	def project_points(self, points):
+		points = np.asarray(points, dtype=np.float32).reshape(-1, 1, 2)
+		return cv2.perspectiveTransform(points, self.matrix).reshape(-1, 2)
@@ -0,0 +1,213 @@
+import collections
+import glob
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from timing_utils import metrics
+
+# Environment variable naming a file or directory of frames to use instead of the camera
+FRAME_SOURCE_ENV = "MAZE_FRAMES"
+
+# Frames (or results) a stage can fall behind by before the oldest get dropped
+DEFAULT_QUEUE_SIZE = 1
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+# A frame, or whatever a stage made of it, tagged with when the frame was captured
+Frame = collections.namedtuple("Frame", ["index", "captured_at", "data"])
+
+# Bounded queue that drops its oldest item instead of blocking the producer.
+#
+# get() hands out the newest item and drops the rest, so a slow consumer always
+# works on the freshest frame instead of catching up on stale ones.
+class LatestQueue:
+	def __init__(self, max_size=DEFAULT_QUEUE_SIZE):
+		self.items = collections.deque(maxlen=max_size)
+		self.condition = threading.Condition()
+		self.closed = False
+		self.dropped = 0
+
+	def put(self, item):
+		with self.condition:
+			if len(self.items) == self.items.maxlen:
+				self.dropped += 1
+			self.items.append(item)
+			self.condition.notify()
+
+	# Newest item, waiting for one if needed. None once the queue is closed and empty.
+	def get(self):
+		with self.condition:
+			while not self.items and not self.closed:
+				self.condition.wait()
+			if not self.items:
+				return None
+			item = self.items.pop()
+			self.dropped += len(self.items)
+			self.items.clear()
+			return item
+
+	def depth(self):
+		with self.condition:
+			return len(self.items)
+
+	# Wakes up get() for good once the queue runs dry
+	def close(self):
+		with self.condition:
+			self.closed = True
+			self.condition.notify_all()
+
+# Frames from an image file or every image in a directory, in name order,
+# for running the pipeline without the Pi camera.
+# interval: seconds between frames, like a camera's frame period
+# loop: start over after the last image
+class FileFrameSource:
+	def __init__(self, path, interval=0, loop=False):
+		if os.path.isdir(path):
+			self.paths = sorted(p for p in glob.glob(os.path.join(path, "*")) if p.lower().endswith(IMAGE_EXTENSIONS))
+		else:
+			self.paths = [path]
+		if not self.paths:
+			raise ValueError("No images found in {}".format(path))
+		self.interval = interval
+		self.loop = loop
+		self.position = 0
+
+	# Next frame, or None when there are no more
+	def read(self):
+		if self.position == len(self.paths):
+			if not self.loop:
+				return None
+			self.position = 0
+		if self.interval:
+			time.sleep(self.interval)
+		image = cv2.imread(self.paths[self.position])
+		self.position += 1
+		return image
+
+# Frames straight from the Pi camera's video port, without saving them to disk
+class CameraFrameSource:
+	def __init__(self):
+		from camera import camera
+		self.camera = camera
+		width, height = camera.resolution
+		# picamera rounds the buffer up to multiples of 32 x 16
+		self.buffer = np.empty((-(-height // 16) * 16, -(-width // 32) * 32, 3), dtype="uint8")
+		self.width, self.height = width, height
+
+	def read(self):
+		self.camera.capture(self.buffer, "bgr", use_video_port=True)
+		return self.buffer[:self.height, :self.width].copy()
+
+# Camera, or the frames named by FRAME_SOURCE_ENV if it is set
+def default_frame_source():
+	path = os.environ.get(FRAME_SOURCE_ENV)
+	if path:
+		return FileFrameSource(path)
+	return CameraFrameSource()
+
+# One step of a StreamingPipeline, with its input queue and what it has seen so far
+class Stage:
+	def __init__(self, name, function, queue_size=DEFAULT_QUEUE_SIZE):
+		self.name = name
+		self.function = function
+		self.queue = LatestQueue(queue_size)
+		self.processed = 0
+		self.max_depth = 0
+		# Seconds between capturing a frame and this stage starting on it
+		self.last_staleness = 0
+		self.max_staleness = 0
+		self.thread = None
+
+	def stats(self):
+		return {
+			"depth": self.queue.depth(),
+			"max_depth": self.max_depth,
+			"dropped": self.queue.dropped,
+			"processed": self.processed,
+			"last_staleness": self.last_staleness,
+			"max_staleness": self.max_staleness,
+		}
+
+# Runs capture and every stage on its own thread, connected by LatestQueues.
+#
+# source: anything with a read() that returns the next frame, or None at the end
+# stages: (name, function) pairs. Each function gets what the stage before it
+# returned (the captured image for the first one). Returning None drops the frame,
+# e.g. when no path was found.
+#
+# While the robot carries out one command the next frame is already being captured
+# and processed, and a stage that falls behind skips to the newest frame.
+class StreamingPipeline:
+	def __init__(self, source, stages, queue_size=DEFAULT_QUEUE_SIZE):
+		self.source = source
+		self.stages = [Stage(name, function, queue_size) for name, function in stages]
+		self.captured = 0
+		self.stopped = threading.Event()
+		self.capture_thread = None
+		self.error = None
+
+	def start(self):
+		self.capture_thread = threading.Thread(target=self.capture_forever, name="capture", daemon=True)
+		for i, stage in enumerate(self.stages):
+			output = self.stages[i + 1].queue if i + 1 < len(self.stages) else None
+			stage.thread = threading.Thread(target=self.process_forever, args=(stage, output), name=stage.name, daemon=True)
+			stage.thread.start()
+		self.capture_thread.start()
+		return self
+
+	def capture_forever(self):
+		try:
+			while not self.stopped.is_set():
+				with metrics.timer("capture"):
+					image = self.source.read()
+				if image is None:
+					break
+				self.stages[0].queue.put(Frame(self.captured, time.monotonic(), image))
+				self.captured += 1
+		except Exception as e:
+			self.error = e
+		finally:
+			self.stages[0].queue.close()
+
+	def process_forever(self, stage, output):
+		try:
+			while True:
+				stage.max_depth = max(stage.max_depth, stage.queue.depth())
+				frame = stage.queue.get()
+				if frame is None or self.stopped.is_set():
+					break
+				stage.last_staleness = time.monotonic() - frame.captured_at
+				stage.max_staleness = max(stage.max_staleness, stage.last_staleness)
+				result = stage.function(frame.data)
+				stage.processed += 1
+				if result is not None and output is not None:
+					output.put(frame._replace(data=result))
+		except Exception as e:
+			self.error = e
+			self.stopped.set()
+		finally:
+			if output is not None:
+				output.close()
+
+	# Stops capturing; every stage finishes what it is working on
+	def stop(self):
+		self.stopped.set()
+
+	# Waits for the last stage to finish, re-raising the first error any thread hit
+	def join(self, timeout=None):
+		for thread in [self.capture_thread] + [stage.thread for stage in self.stages]:
+			thread.join(timeout)
+		if self.error is not None:
+			raise self.error
+
+	def stats(self):
+		return {stage.name: stage.stats() for stage in self.stages}
+
+	def report(self):
+		print("Captured {} frames".format(self.captured))
+		for name, stats in self.stats().items():
+			print("{}: processed {processed}, dropped {dropped}, queue depth {depth} (max {max_depth}), staleness {last_staleness:.3f} s (max {max_staleness:.3f} s)".format(name, **stats), flush=True)
@@ -0,0 +1,152 @@
+import atexit
+import csv
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+# Environment variable naming a .json or .csv file to dump the default metrics to at exit
+METRICS_PATH_ENV = "MAZE_METRICS"
+
+# Latest samples every stage keeps for its percentiles
+DEFAULT_WINDOW = 1024
+
+PERCENTILES = (50, 95, 99)
+
+# Latencies of the last window samples of one stage, plus totals over all of them
+class RollingHistogram:
+	def __init__(self, window=DEFAULT_WINDOW):
+		self.samples = np.zeros(window)
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def add(self, seconds):
+		self.samples[self.count % len(self.samples)] = seconds
+		self.count += 1
+		self.total += seconds
+		self.max = max(self.max, seconds)
+
+	# Samples still in the window, oldest first
+	def window(self):
+		if self.count <= len(self.samples):
+			return self.samples[:self.count]
+		start = self.count % len(self.samples)
+		return np.concatenate((self.samples[start:], self.samples[:start]))
+
+	def percentiles(self, percentiles=PERCENTILES):
+		window = self.window()
+		if len(window) == 0:
+			return {p: 0.0 for p in percentiles}
+		return dict(zip(percentiles, np.percentile(window, percentiles)))
+
+	def summary(self):
+		summary = {"count": self.count, "mean": self.total / self.count if self.count else 0.0, "max": self.max}
+		for p, value in self.percentiles().items():
+			summary["p{}".format(p)] = float(value)
+		return summary
+
+# Per-stage latencies and named counters for the whole pipeline.
+#
+# Time a stage with
+#	with metrics.timer("projection"):
+#		...
+# or by decorating a function with @metrics.timed("bfs"), and count events with
+# metrics.count("replans"). Timers use the monotonic perf_counter clock. Every
+# method can be called from any thread.
+class Metrics:
+	def __init__(self, window=DEFAULT_WINDOW):
+		self.window = window
+		self.histograms = {}
+		self.counters = {}
+		self.lock = threading.Lock()
+
+	def record(self, stage, seconds):
+		with self.lock:
+			if stage not in self.histograms:
+				self.histograms[stage] = RollingHistogram(self.window)
+			self.histograms[stage].add(seconds)
+
+	@contextmanager
+	def timer(self, stage):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.record(stage, time.perf_counter() - start)
+
+	def timed(self, stage):
+		def decorator(function):
+			@functools.wraps(function)
+			def wrapper(*args, **kwargs):
+				with self.timer(stage):
+					return function(*args, **kwargs)
+			return wrapper
+		return decorator
+
+	# Adds every sample and counter of other to these metrics
+	def merge(self, other):
+		with other.lock:
+			histograms = list(other.histograms.items())
+			counters = dict(other.counters)
+		for stage, histogram in histograms:
+			for seconds in histogram.window():
+				self.record(stage, seconds)
+		for name, value in counters.items():
+			self.count(name, value)
+
+	def count(self, name, amount=1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + amount
+
+	# {"stages": {stage: {count, mean, max, p50, p95, p99}}, "counters": {name: count}},
+	# with times in seconds
+	def summary(self):
+		with self.lock:
+			return {
+				"stages": {stage: histogram.summary() for stage, histogram in self.histograms.items()},
+				"counters": dict(self.counters),
+			}
+
+	def report(self):
+		summary = self.summary()
+		for stage, stats in summary["stages"].items():
+			print("{}: {count} runs, p50 {p50:.4f} s, p95 {p95:.4f} s, p99 {p99:.4f} s, max {max:.4f} s".format(stage, **stats))
+		for name, value in summary["counters"].items():
+			print("{}: {}".format(name, value))
+
+	# Writes the summary to path, as CSV if it ends in .csv and as JSON otherwise.
+	# The CSV has one row per stage, then one row per counter with only its count.
+	def dump(self, path):
+		summary = self.summary()
+		if path.endswith(".csv"):
+			columns = ["name", "count", "mean", "max"] + ["p{}".format(p) for p in PERCENTILES]
+			with open(path, "w", newline="") as f:
+				writer = csv.DictWriter(f, columns)
+				writer.writeheader()
+				for stage, stats in summary["stages"].items():
+					writer.writerow(dict(stats, name=stage))
+				for name, value in summary["counters"].items():
+					writer.writerow({"name": name, "count": value})
+		else:
+			with open(path, "w") as f:
+				json.dump(summary, f, indent=2)
+
+	def reset(self):
+		with self.lock:
+			self.histograms.clear()
+			self.counters.clear()
+
+# Metrics used by the pipeline modules, dumped at exit if METRICS_PATH_ENV is set
+metrics = Metrics()
+
+def dump_metrics_at_exit():
+	path = os.environ.get(METRICS_PATH_ENV)
+	if path:
+		metrics.dump(path)
+
+atexit.register(dump_metrics_at_exit)